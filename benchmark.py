@@ -0,0 +1,602 @@
+"""
+correio.fabricadofuturo.com - benchmark
+
+Copyright 2023 Fábrica do Futuro
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import sys
+
+try:
+  import argparse
+  import asyncio
+  import json
+  import os
+  import random
+  import shutil
+  import struct
+  import subprocess
+  import tempfile
+  import time
+  import urllib.parse
+  import zlib
+except Exception as e:
+  logging.exception(e)
+  sys.exit(repr(e))
+
+logger: logging.Logger = logging.getLogger("benchmark")
+
+repo_path: str = os.path.dirname(os.path.abspath(__file__))
+
+rotas: tuple[str, ...] = (
+  "GET /",
+  "POST /",
+  "GET /display",
+  "GET /api/correios",
+  "POST /mensagens",
+)
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+  """Argumentos de linha de comando"""
+  parser: argparse.ArgumentParser = argparse.ArgumentParser(
+    description = "Benchmark do Correio Elegante",
+  )
+  parser.add_argument("--mensagens", type = int, default = 50)
+  parser.add_argument("--correios", type = int, default = 1000)
+  parser.add_argument("--requests", type = int, default = 200)
+  parser.add_argument("--concurrency", type = int, default = 10)
+  parser.add_argument(
+    "--rotas",
+    nargs = "+",
+    default = list(rotas),
+    help = "Rotas a medir, ex.: 'GET /display'",
+  )
+  parser.add_argument(
+    "--uvicorn",
+    action = "store_true",
+    help = "Sobe uvicorn de verdade num UNIX socket",
+  )
+  parser.add_argument(
+    "--storage",
+    choices = ("zodb", "sqlite"),
+    default = "zodb",
+    help = "Backend de armazenamento do servidor medido",
+  )
+  parser.add_argument(
+    "--sqlite-synchronous",
+    choices = ("OFF", "NORMAL", "FULL", "EXTRA"),
+    default = None,
+    help = "PRAGMA synchronous do SQLite (padrão: o do servidor)",
+  )
+  parser.add_argument(
+    "--compara-storage",
+    action = "store_true",
+    help = "Compara leitura e escrita de ZODB e SQLite, sem HTTP",
+  )
+  parser.add_argument(
+    "--output",
+    default = None,
+    help = "Arquivo JSON de resultados (padrão: stdout)",
+  )
+  return parser.parse_args(argv)
+
+class ContaErros(logging.Handler):
+  """Conta registros de log de nível ERROR ou acima"""
+  def __init__(self) -> None:
+    super().__init__(level = logging.ERROR)
+    self.erros: int = 0
+  def emit(self, record: logging.LogRecord) -> None:
+    self.erros += 1
+
+def png_pequeno(n: int) -> bytes:
+  """PNG 8x8 de uma cor só, diferente pra cada n"""
+  def bloco(tipo: bytes, dados: bytes) -> bytes:
+    return struct.pack(">I", len(dados)) + tipo + dados + \
+      struct.pack(">I", zlib.crc32(tipo + dados))
+  cor: bytes = n.to_bytes(3, "big")
+  linhas: bytes = (b"\x00" + cor * 8) * 8
+  return b"\x89PNG\r\n\x1a\n" + \
+    bloco(b"IHDR", struct.pack(">IIBBBBB", 8, 8, 8, 2, 0, 0, 0)) + \
+    bloco(b"IDAT", zlib.compress(linhas)) + \
+    bloco(b"IEND", b"")
+
+def prepara_imagens(
+  main: object,
+  n_mensagens: int,
+  n_novas: int,
+) -> tuple[str, set[str]]:
+  """Cria imagens de verdade numa pasta temporária em static/imagens
+
+  As mensagens semeadas usam `<pasta>/bench-<i>.png` e as de POST 
+  /mensagens `<pasta>/novo-<i>.png`. Retorna a pasta (relativa a 
+  static/imagens) e as variantes que já existiam, pra limpeza depois.
+  """
+  os.makedirs(main.imagens_path, exist_ok = True)
+  pasta: str = os.path.basename(tempfile.mkdtemp(
+    prefix = "bench-",
+    dir = main.imagens_path,
+  ))
+  for i in range(n_mensagens):
+    with open(
+      os.path.join(main.imagens_path, pasta, f"bench-{i}.png"),
+      "wb",
+    ) as f:
+      f.write(png_pequeno(i))
+  for i in range(n_novas):
+    with open(
+      os.path.join(main.imagens_path, pasta, f"novo-{i}.png"),
+      "wb",
+    ) as f:
+      f.write(png_pequeno(n_mensagens + i))
+  variantes: set[str] = set(os.listdir(main.variantes_path)) \
+    if os.path.isdir(main.variantes_path) else set()
+  return pasta, variantes
+
+def limpa_imagens(main: object, pasta: str, variantes: set[str]) -> None:
+  """Apaga as imagens e variantes criadas pelo benchmark"""
+  shutil.rmtree(os.path.join(main.imagens_path, pasta), ignore_errors = True)
+  try:
+    os.rmdir(main.imagens_path)
+  except OSError:
+    pass
+  if os.path.isdir(main.variantes_path):
+    for nome in set(os.listdir(main.variantes_path)) - variantes:
+      os.remove(os.path.join(main.variantes_path, nome))
+
+def prepara_instancia(
+  workdir: str,
+  storage: str = "zodb",
+  sqlite_synchronous: str | None = None,
+) -> str:
+  """Cria instance/config.ini num diretório temporário"""
+  os.makedirs(os.path.join(workdir, "instance"))
+  socket: str = os.path.join(workdir, "uvicorn.socket")
+  with open(os.path.join(workdir, "instance", "config.ini"), "w") as f:
+    f.write(f"""[uvicorn]
+host = 127.0.0.1
+port = 8080
+socket = {socket}
+log_level = warning
+responsavel = Benchmark
+
+[storage]
+backend = {storage}
+""")
+    if sqlite_synchronous:
+      f.write(f"sqlite_synchronous = {sqlite_synchronous}\n")
+  return socket
+
+async def semeia(
+  main: object,
+  pasta: str,
+  n_mensagens: int,
+  n_correios: int,
+) -> list:
+  """Popula o banco com mensagens e correios"""
+  for i in range(n_mensagens):
+    _return: dict = await main.set_mensagem(
+      f"{pasta}/bench-{i}.png",
+      f"Mensagem {i}",
+    )
+    if not _return['status']:
+      raise RuntimeError(f"Mensagem {i}: {_return['error']}")
+  ids: list[str] = [
+    mensagem['id'] for mensagem in (await main.get_mensagens())['data']
+  ]
+  db: object = await main.get_storage('correios')
+  for start in range(0, n_correios, 1000):
+    await main.run_db(
+      db,
+      main._set_correios_batch,
+      [
+        ({}, f"De {i}", f"Para {i}", ids[i % len(ids)]) \
+        for i in range(start, min(start + 1000, n_correios)) \
+      ],
+      write = True,
+    )
+  return ids
+
+def percentil(amostras: list[float], p: float) -> float | None:
+  """Percentil por vizinho mais próximo"""
+  if not amostras:
+    return None
+  ordenadas: list[float] = sorted(amostras)
+  return ordenadas[min(len(ordenadas) - 1, int(p / 100 * len(ordenadas)))]
+
+async def mede(
+  requisita: object,
+  n_requests: int,
+  concurrency: int,
+) -> dict[str, float | int | None]:
+  """Dispara requisições concorrentes e mede latência"""
+  latencias: list[float] = []
+  erros: int = 0
+  semaforo: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+  async def uma(i: int) -> None:
+    nonlocal erros
+    async with semaforo:
+      start: float = time.perf_counter()
+      try:
+        status: int = await requisita(i)
+        if status >= 400:
+          erros += 1
+      except Exception as e:
+        logger.exception(e)
+        erros += 1
+      latencias.append(time.perf_counter() - start)
+  start: float = time.perf_counter()
+  await asyncio.gather(*[uma(i) for i in range(n_requests)])
+  elapsed: float = time.perf_counter() - start
+  return {
+    'requests': n_requests,
+    'errors': erros,
+    'seconds': elapsed,
+    'rps': n_requests / elapsed if elapsed else None,
+    'p50': percentil(latencias, 50),
+    'p95': percentil(latencias, 95),
+    'p99': percentil(latencias, 99),
+  }
+
+def requisicao(
+  rota: str,
+  ids: list[str],
+  pasta: str,
+) -> tuple[str, str, object]:
+  """Retorna método, caminho e gerador de corpo pra uma rota"""
+  method, path = rota.split(" ", 1)
+  body: object = None
+  if rota == "POST /":
+    body = lambda i: {
+      'de': f"Bench {i}",
+      'para': f"Alvo {i}",
+      'mensagem': ids[i % len(ids)],
+    }
+  elif rota == "POST /mensagens":
+    body = lambda i: {
+      'path': f"{pasta}/novo-{i}.png",
+      'description': f"Nova {i}",
+    }
+  return method, path, body
+
+async def http_unix(
+  socket: str,
+  method: str,
+  path: str,
+  form: dict | None,
+) -> int:
+  """Requisição HTTP/1.1 mínima num UNIX socket"""
+  reader, writer = await asyncio.open_unix_connection(socket)
+  try:
+    body: bytes = urllib.parse.urlencode(form).encode() if form else b""
+    headers: str = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n\
+Connection: close\r\nContent-Length: {len(body)}\r\n"
+    if form:
+      headers += "Content-Type: application/x-www-form-urlencoded\r\n"
+    writer.write(headers.encode() + b"\r\n" + body)
+    await writer.drain()
+    status_line: bytes = await reader.readline()
+    await reader.read()
+    return int(status_line.split()[1])
+  finally:
+    writer.close()
+
+async def espera_socket(socket: str, timeout: float = 30) -> None:
+  """Espera o uvicorn abrir o socket"""
+  deadline: float = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      if await http_unix(socket, "GET", "/quedelhe", None):
+        return
+    except OSError:
+      await asyncio.sleep(0.1)
+  raise TimeoutError("uvicorn não subiu")
+
+async def roda(args: argparse.Namespace, workdir: str) -> dict:
+  """Semeia o banco e mede cada rota
+
+  Erro logado pelo servidor (no processo ou no log do uvicorn) conta em 
+  `logged_errors`, e o benchmark sai com erro se tiver algum.
+  """
+  socket: str = prepara_instancia(
+    workdir,
+    args.storage,
+    args.sqlite_synchronous,
+  )
+  os.chdir(workdir)
+  sys.path.insert(0, repo_path)
+  import main
+  contador: ContaErros = ContaErros()
+  logging.getLogger().addHandler(contador)
+  pasta, variantes = prepara_imagens(main, args.mensagens, args.requests)
+  try:
+    return await mede_rotas(main, args, workdir, socket, pasta, contador)
+  finally:
+    logging.getLogger().removeHandler(contador)
+    limpa_imagens(main, pasta, variantes)
+
+async def mede_rotas(
+  main: object,
+  args: argparse.Namespace,
+  workdir: str,
+  socket: str,
+  pasta: str,
+  contador: ContaErros,
+) -> dict:
+  """Semeia o banco com as imagens de `pasta` e mede cada rota"""
+  resultados: dict[str, dict] = {}
+  erros_servidor: int = 0
+  async with main.app.test_app() as test_app:
+    start: float = time.perf_counter()
+    ids: list[str] = await semeia(
+      main,
+      pasta,
+      args.mensagens,
+      args.correios,
+    )
+    seed_seconds: float = time.perf_counter() - start
+    if not args.uvicorn:
+      client: object = test_app.test_client()
+      for rota in args.rotas:
+        method, path, body = requisicao(rota, ids, pasta)
+        async def requisita(i: int) -> int:
+          response: object = await client.open(
+            path,
+            method = method,
+            form = body(i) if body else None,
+          )
+          await response.get_data()
+          return response.status_code
+        resultados[rota] = await mede(
+          requisita,
+          args.requests,
+          args.concurrency,
+        )
+  if args.uvicorn:
+    log_path: str = os.path.join(workdir, "uvicorn.log")
+    log: object = open(log_path, "w")
+    server: subprocess.Popen = subprocess.Popen(
+      [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--uds", socket,
+        "--log-level", "warning",
+      ],
+      cwd = workdir,
+      env = {
+        **os.environ,
+        'PYTHONPATH': os.pathsep.join(
+          [repo_path, os.environ.get('PYTHONPATH', '')],
+        ),
+      },
+      stderr = log,
+    )
+    try:
+      await espera_socket(socket)
+      for rota in args.rotas:
+        method, path, body = requisicao(rota, ids, pasta)
+        async def requisita(i: int) -> int:
+          return await http_unix(
+            socket,
+            method,
+            path,
+            body(i) if body else None,
+          )
+        resultados[rota] = await mede(
+          requisita,
+          args.requests,
+          args.concurrency,
+        )
+    finally:
+      server.terminate()
+      server.wait()
+      log.close()
+    with open(log_path) as f:
+      texto: str = f.read()
+    erros_servidor = sum(
+      linha.startswith(("ERROR", "CRITICAL")) \
+      for linha in texto.splitlines() \
+    )
+    if erros_servidor:
+      sys.stderr.write(texto)
+  return {
+    'commit': git_commit(),
+    'modo': "uvicorn" if args.uvicorn else "test_client",
+    'storage': args.storage,
+    'sqlite_synchronous': main.sqlite_synchronous,
+    'mensagens': args.mensagens,
+    'correios': args.correios,
+    'requests': args.requests,
+    'concurrency': args.concurrency,
+    'seed_seconds': seed_seconds,
+    'logged_errors': contador.erros + erros_servidor,
+    'resultados': resultados,
+  }
+
+async def mede_storage(
+  main: object,
+  backend: str,
+  args: argparse.Namespace,
+) -> dict[str, dict]:
+  """Semeia um backend e mede os jobs de leitura e escrita nele"""
+  dbs: dict[str, object] = await main.abre_storage(backend)
+  resultados: dict[str, dict] = {}
+  try:
+    mensagens: list[dict] = [
+      {
+        'id': f"bench-{i:04d}",
+        'path': f"bench-{i}.png",
+        'description': f"Mensagem {i}",
+      } for i in range(args.mensagens)
+    ]
+    await main.run_db(
+      dbs['mensagens'],
+      main._importa_registros,
+      'mensagens',
+      mensagens,
+      write = True,
+    )
+    retornos: list[dict] = []
+    start: float = time.perf_counter()
+    for inicio in range(0, args.correios, 1000):
+      lote: list[tuple] = [
+        (
+          {},
+          f"De {i}",
+          f"Para {i % 100}",
+          mensagens[i % len(mensagens)]['id'],
+        ) \
+        for i in range(inicio, min(inicio + 1000, args.correios)) \
+      ]
+      await main.run_db(
+        dbs['correios'],
+        main._set_correios_batch,
+        lote,
+        write = True,
+      )
+      retornos.extend(_return for (_return, *_) in lote)
+    elapsed: float = time.perf_counter() - start
+    resultados['escrita_lote'] = {
+      'records': args.correios,
+      'seconds': elapsed,
+      'rps': args.correios / elapsed if elapsed else None,
+    }
+    ids: list[str] = [_return['data']['id'] for _return in retornos]
+    async def job(write: bool, db: object, funcao: object, *job_args) -> int:
+      """Roda um job e devolve 200 se deu certo, como as rotas"""
+      _return: dict = {
+        'status': False,
+        'error': None,
+        'exception': None,
+        'data': None,
+      }
+      await main.run_db(db, funcao, _return, *job_args, write = write)
+      return 200 if _return['status'] else 500
+    medidas: dict[str, object] = {
+      'escrita_unica': lambda i: job(
+        True,
+        dbs['correios'],
+        main._set_correio,
+        f"De {i}",
+        f"Para {i % 100}",
+        mensagens[i % len(mensagens)]['id'],
+      ),
+      'leitura_pagina': lambda i: job(
+        False,
+        dbs['correios'],
+        main._get_correios,
+        0,
+        50,
+        True,
+      ),
+      'leitura_id': lambda i: job(
+        False,
+        dbs['correios'],
+        main._get_correio,
+        random.choice(ids),
+      ),
+      'leitura_para': lambda i: job(
+        False,
+        dbs['correios'],
+        main._get_correios_by_para,
+        f"Para {i % 100}",
+      ),
+      'leitura_cursor': lambda i: job(
+        False,
+        dbs['correios'],
+        main._get_correios_since,
+        random.randrange(max(args.correios - 50, 1)),
+        50,
+      ),
+      'catalogo': lambda i: job(False, dbs['mensagens'], main._load_mensagens),
+    }
+    for nome, requisita in medidas.items():
+      resultados[nome] = await mede(requisita, args.requests, args.concurrency)
+    start = time.perf_counter()
+    lidos: int = 0
+    cursor: int = 0
+    while True:
+      _return: dict = {'status': False, 'data': None}
+      await main.run_db(
+        dbs['correios'],
+        main._get_correios_since,
+        _return,
+        cursor,
+        500,
+      )
+      if not _return['data']:
+        break
+      lidos += len(_return['data'])
+      cursor = _return['cursor']
+    elapsed = time.perf_counter() - start
+    resultados['varredura'] = {
+      'records': lidos,
+      'seconds': elapsed,
+      'rps': lidos / elapsed if elapsed else None,
+    }
+  finally:
+    await main.fecha_storage(dbs)
+  return resultados
+
+async def roda_storage(args: argparse.Namespace, workdir: str) -> dict:
+  """Compara os backends de armazenamento com o mesmo conjunto de dados"""
+  prepara_instancia(workdir, sqlite_synchronous = args.sqlite_synchronous)
+  os.chdir(workdir)
+  sys.path.insert(0, repo_path)
+  import main
+  return {
+    'commit': git_commit(),
+    'modo': "storage",
+    'sqlite_synchronous': main.sqlite_synchronous,
+    'mensagens': args.mensagens,
+    'correios': args.correios,
+    'requests': args.requests,
+    'concurrency': args.concurrency,
+    'resultados': {
+      backend: await mede_storage(main, backend, args) \
+      for backend in ("zodb", "sqlite") \
+    },
+  }
+
+def git_commit() -> str | None:
+  """Commit atual, pra comparar resultados entre commits"""
+  try:
+    return subprocess.run(
+      ["git", "rev-parse", "--short", "HEAD"],
+      cwd = repo_path,
+      capture_output = True,
+      text = True,
+      check = True,
+    ).stdout.strip()
+  except Exception:
+    return None
+
+if __name__ == '__main__':
+  args: argparse.Namespace = parse_args()
+  output: str | None = os.path.abspath(args.output) if args.output \
+    else None
+  logging.basicConfig(level = logging.WARNING)
+  with tempfile.TemporaryDirectory(prefix = "correio-bench-") as workdir:
+    report: dict = asyncio.run(
+      roda_storage(args, workdir) if args.compara_storage \
+      else roda(args, workdir)
+    )
+  texto: str = json.dumps(report, indent = 2)
+  if output:
+    with open(output, "w") as f:
+      f.write(texto)
+  else:
+    print(texto)
+  if report.get('logged_errors'):
+    sys.exit(f"{report['logged_errors']} erro(s) logado(s) no benchmark")
@@ -19,32 +19,52 @@ limitations under the License.
 
 import logging
 import sys
+import time
+
+import_start: float = time.perf_counter()
 
 try:
   from quart import (
     abort,
     flask_patch,
-    jsonify,
+    g,
+    has_request_context,
+    make_response,
     Quart,
+    Response,
     render_template,
     render_template_string,
     request,
+    url_for,
   )
   from flask_wtf import FlaskForm
+  import abc
   import asyncio
+  import bisect
+  import click
+  from collections.abc import AsyncIterator, Callable
+  from concurrent.futures import Future, ThreadPoolExecutor
   from configparser import ConfigParser, NoSectionError
+  import gzip
+  import hashlib
+  import itertools
+  import json
+  import mimetypes
   from jinja2 import TemplateNotFound
+  from markupsafe import Markup
   import os
   import random
   import secrets
-  import uvicorn
+  import sqlite3
+  import threading
   from wtforms import (
     RadioField,
     StringField,
     SubmitField,
     validators,
   )
-  import BTrees
+  import BTrees.IOBTree
+  import BTrees.OOBTree
   import transaction
   import uuid
   import zc.zlibstorage
@@ -54,14 +74,135 @@ except Exception as e:
   logging.exception(e)
   sys.exit(repr(e))
 
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+startup_times: dict[str, float] = {
+  'imports': time.perf_counter() - import_start,
+}
 config_file: str = os.path.join("instance", "config.ini")
 zodb_path: str = os.path.join("instance", "zodb")
+storage_backend: str = "zodb"
+sqlite_path: str = os.path.join("instance", "correio.sqlite3")
+sqlite_synchronous: str = "FULL"
 uvicorn_socket: str | None = None
 uvicorn_host: str | None = None
 uvicorn_port: str | None = None
 log_level: str | None = None
 responsável: str = "Responsável"
+zodb_pool_size: int = 7
+zodb_cache_size: int = 400
+storage_workers: int = 4
+storage_queue_depth: int = 64
+storage_attempts: int = 3
+zodb_backend: str = "filestorage"
+zodb_zeo_address: str = "127.0.0.1:8100"
+zodb_poll_ms: int = 250
+uvicorn_workers: int = 1
+zeo_poll_task: asyncio.Task | None = None
+pack_interval: int = 0
+pack_growth_mb: int = 0
+pack_days: float = 0
+pack_keep_old: bool = True
+pack_task: asyncio.Task | None = None
+index_interval: int = 60
+index_task: asyncio.Task | None = None
+assets_task: asyncio.Task | None = None
+index_saved: dict[str, bytes] = {}
+pack_state: dict[str, dict[str, float]] = {}
+databases: dict[str, object] = {}
+storage_executor: ThreadPoolExecutor | None = None
+storage_semaphore: asyncio.Semaphore | None = None
+storage_local: threading.local = threading.local()
+storage_lock: threading.Lock = threading.Lock()
+storage_write_locks: dict[int, threading.Lock] = {}
+storage_connections: list[object] = []
+record_fields: dict[str, tuple[str, ...]] = {
+  'correios': ('id', 'de', 'para', 'mensagem', 'seq', 'chave'),
+  'mensagens': ('id', 'path', 'description', 'hash', 'variantes'),
+}
+indices: dict[str, dict[str, bool]] = {
+  'correios': {'para': False, 'chave': True},
+  'mensagens': {'path': True, 'hash': True},
+}
+mensagens_cache: dict[str, object] = {
+  'version': 0,
+  'loaded': -1,
+  'lista': None,
+  'dict': None,
+  'hits': 0,
+  'misses': 0,
+}
+group_commit_enabled: bool = False
+group_commit_ms: int = 5
+group_commit_size: int = 64
+correio_queue: asyncio.Queue | None = None
+group_commit_task: asyncio.Task | None = None
+static_path: str = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)),
+  "static",
+)
+imagens_path: str = os.path.join(static_path, "imagens")
+variantes_path: str = os.path.join(static_path, "variantes")
+variantes_larguras: list[int] = [320, 1280]
+assets_path: str = os.path.join("instance", "assets")
+assets_memory_limit: int = 512 * 1024
+assets_compress: tuple[str, ...] = (
+  ".css",
+  ".html",
+  ".js",
+  ".json",
+  ".py",
+  ".svg",
+  ".toml",
+  ".txt",
+)
+assets_manifest: dict[str, dict] = {}
+assets_hashed: dict[str, dict] = {}
+display_mode: str = "pyscript"
+display_window: int = 50
+display_queue_size: int = 32
+ultimo_seq: int = 0
+paginas_cache: dict[str, object] = {
+  'fragmentos_version': None,
+  'fragmentos': None,
+  'display_key': None,
+  'display': None,
+  'hits': 0,
+  'misses': 0,
+}
+display_keepalive: int = 15
+display_subscribers: set[asyncio.Queue] = set()
+storage_metrics: dict[str, int] = {
+  'waiting': 0,
+  'queued': 0,
+  'max_queued': 0,
+  'running': 0,
+  'completed': 0,
+  'failed': 0,
+  'conflicts': 0,
+  'group_commits': 0,
+  'group_commit_records': 0,
+  'packs': 0,
+  'pack_bytes_reclaimed': 0,
+}
+
+timing_buckets: tuple[float, ...] = (
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+timing_metrics: dict[tuple[str, str], dict[str, object]] = {}
+slow_request_ms: int = 0
+api_tokens: list[str] = []
+lote_max: int = 500
 
+config_start: float = time.perf_counter()
 try:
   config: ConfigParser = ConfigParser()
   config.read(config_file)
@@ -70,21 +211,138 @@ try:
   uvicorn_port = int(config["uvicorn"]["port"])
   log_level = config["uvicorn"]["log_level"]
   responsável = config["uvicorn"]["responsavel"]
+  zodb_pool_size = config.getint("zodb", "pool_size", fallback = 7)
+  zodb_cache_size = config.getint("zodb", "cache_size", fallback = 400)
+  storage_workers = config.getint("zodb", "workers", fallback = 4)
+  storage_attempts = config.getint("zodb", "attempts", fallback = 3)
+  zodb_backend = config.get("zodb", "backend", fallback = "filestorage")
+  zodb_zeo_address = config.get(
+    "zodb",
+    "zeo_address",
+    fallback = "127.0.0.1:8100",
+  )
+  zodb_poll_ms = config.getint("zodb", "poll_ms", fallback = 250)
+  pack_interval = config.getint("zodb", "pack_interval", fallback = 0)
+  pack_growth_mb = config.getint("zodb", "pack_growth_mb", fallback = 0)
+  pack_days = config.getfloat("zodb", "pack_days", fallback = 0)
+  index_interval = config.getint("zodb", "index_interval", fallback = 60)
+  pack_keep_old = config.getboolean(
+    "zodb",
+    "pack_keep_old",
+    fallback = True,
+  )
+  uvicorn_workers = config.getint("uvicorn", "workers", fallback = 1)
+  storage_queue_depth = config.getint(
+    "zodb",
+    "queue_depth",
+    fallback = 64,
+  )
+  group_commit_enabled = config.getboolean(
+    "zodb",
+    "group_commit",
+    fallback = False,
+  )
+  group_commit_ms = config.getint("zodb", "group_commit_ms", fallback = 5)
+  group_commit_size = config.getint(
+    "zodb",
+    "group_commit_size",
+    fallback = 64,
+  )
+  variantes_larguras = sorted(
+    int(largura) for largura in config.get(
+      "imagens",
+      "larguras",
+      fallback = "320, 1280",
+    ).split(",")
+  )
+  display_mode = config.get("display", "mode", fallback = "pyscript")
+  display_window = config.getint("display", "window", fallback = 50)
+  display_queue_size = config.getint(
+    "display",
+    "queue_size",
+    fallback = 32,
+  )
+  display_keepalive = config.getint("display", "keepalive", fallback = 15)
+  slow_request_ms = config.getint(
+    "metricas",
+    "slow_request_ms",
+    fallback = 0,
+  )
+  api_tokens = [
+    token.strip() for token in config.get(
+      "api",
+      "tokens",
+      fallback = "",
+    ).split(",") if token.strip()
+  ]
+  lote_max = config.getint("api", "lote_max", fallback = 500)
+  storage_backend = config.get("storage", "backend", fallback = "zodb")
+  sqlite_path = config.get("storage", "sqlite_path", fallback = sqlite_path)
+  sqlite_synchronous = config.get(
+    "storage",
+    "sqlite_synchronous",
+    fallback = sqlite_synchronous,
+  ).upper()
+  if sqlite_synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"sqlite_synchronous inválido: {sqlite_synchronous}")
 except (Exception, NoSectionError) as e:
   logging.exception(e)
   sys.exit("Arquivo de configuração não existe ou tá errado")
 
+startup_times['config'] = time.perf_counter() - config_start
+
 logging.basicConfig(level = log_level.upper())
 logger: logging.Logger = logging.getLogger(__name__)
 
+def rota_atual() -> str:
+  """Regra da rota da requisição atual, pra rotular métricas"""
+  if not has_request_context():
+    return "background"
+  if request.url_rule is None:
+    return "404"
+  return request.url_rule.rule
+
+def observe(fase: str, segundos: float) -> None:
+  """Registra duração de uma fase no histograma da rota atual
+
+  Só é chamada no event loop, então dispensa lock. Dentro de uma 
+  requisição a duração também é somada em `g.tempos`, que vai pro log 
+  de requisições lentas.
+  """
+  rota: str = rota_atual()
+  histograma: dict[str, object] | None = timing_metrics.get((fase, rota))
+  if histograma is None:
+    histograma = timing_metrics[(fase, rota)] = {
+      'buckets': [0] * (len(timing_buckets) + 1),
+      'sum': 0.0,
+      'count': 0,
+    }
+  histograma['buckets'][bisect.bisect_left(timing_buckets, segundos)] += 1
+  histograma['sum'] += segundos
+  histograma['count'] += 1
+  if has_request_context() and hasattr(g, 'tempos'):
+    g.tempos[fase] = g.tempos.get(fase, 0.0) + segundos
+
+def marca_tempo(*_status: bool, marcas: dict, chave: str) -> None:
+  """Hook de transação que marca o instante atual em `marcas[chave]`"""
+  marcas[chave] = time.perf_counter()
+
 async def croak_db(db: object) -> None:
-  """Encerra a conexão com ZODB"""
+  """Fecha o banco de dados"""
   try:
     db.close()
   except Exception as e:
     logger.exception(e)
     logger.warning("ZODB já estava fechada")
 
+async def croak_connection(storage: object, connection: object) -> None:
+  """Fecha conexão com o banco de dados"""
+  try:
+    storage.disconnect(connection)
+  except Exception as e:
+    logger.exception(e)
+    logger.warning("Conexão já estava fechada")
+
 async def croak_transaction(transaction: object) -> None:
   """Encerra transação com ZODB"""
   try:
@@ -93,65 +351,1222 @@ async def croak_transaction(transaction: object) -> None:
     logger.exception(e)
     logger.warning("Transação já estava fechada")
 
-async def get_db(path: str) -> None | object:
-  """Retorna objeto de conexão com ZODB (compressed FileStorage)"""
+def zeo_address() -> str | tuple[str, int]:
+  """Endereço do servidor ZEO: host:porta ou caminho de UNIX socket"""
+  host, _sep, port = zodb_zeo_address.rpartition(":")
+  if host and port.isdigit():
+    return (host, int(port))
+  return zodb_zeo_address
+
+async def open_db(path: str) -> None | object:
+  """Abre banco de dados ZODB (compressed FileStorage ou ZEO)
+
+  Com backend zeo o nome do arquivo sem .fs vira o nome do storage no 
+  servidor, que comprime com serverzlibstorage (ver example.zeo.conf).
+  """
   try:
-    try:
-      storage: object = ZODB.FileStorage.FileStorage(path)
-    except FileNotFoundError:
-      os.makedirs(os.path.dirname(path))
-      storage: object = ZODB.FileStorage.FileStorage(path)
+    if zodb_backend == "zeo":
+      import ZEO.ClientStorage
+      storage: object = ZEO.ClientStorage.ClientStorage(
+        zeo_address(),
+        storage = os.path.splitext(os.path.basename(path))[0],
+        wait_timeout = 30,
+      )
+    else:
+      try:
+        storage: object = ZODB.FileStorage.FileStorage(
+          path,
+          pack_keep_old = pack_keep_old,
+        )
+      except FileNotFoundError:
+        os.makedirs(os.path.dirname(path))
+        storage: object = ZODB.FileStorage.FileStorage(
+          path,
+          pack_keep_old = pack_keep_old,
+        )
     compressed_storage: object = zc.zlibstorage.ZlibStorage(storage)
-    db: object = ZODB.DB(compressed_storage)
-    return db
+    for attempt in range(storage_attempts):
+      try:
+        db: object = ZODB.DB(
+          compressed_storage,
+          pool_size = max(zodb_pool_size, storage_workers),
+          cache_size = zodb_cache_size,
+        )
+        return db
+      except ZODB.POSException.ConflictError:
+        ## Outro worker criou a raiz de um banco novo ao mesmo tempo
+        if attempt + 1 >= storage_attempts:
+          raise
+        logger.warning(f"Conflito abrindo {path}, tentando de novo")
+  except Exception as e:
+    logger.exception(e)
+  return None
+
+def storage_path(tree: str) -> str:
+  """Arquivo onde fica a árvore `tree` (correios ou mensagens)
+
+  No ZODB cada árvore tem o seu .fs; no SQLite as duas ficam no mesmo 
+  arquivo.
+  """
+  if storage_backend == "sqlite":
+    return sqlite_path
+  return f"{zodb_path}/{tree}.fs"
+
+async def open_storage(
+  path: str,
+  backend: str | None = None,
+) -> None | object:
+  """Abre o backend `backend` (ou o do config.ini) no arquivo `path`"""
+  try:
+    if (backend or storage_backend) == "sqlite":
+      return await asyncio.to_thread(SQLiteStorage, path)
+    db: object | None = await open_db(path)
+    if db:
+      return ZODBStorage(db)
+  except Exception as e:
+    logger.exception(e)
+  return None
+
+async def get_db(path: str) -> None | object:
+  """Retorna o backend aberto no arquivo `path`, uma vez só por processo"""
+  try:
+    if path not in databases:
+      start: float = time.perf_counter()
+      storage: object | None = await open_storage(path)
+      observe('db_open', time.perf_counter() - start)
+      if not storage:
+        return None
+      databases[path] = storage
+    return databases[path]
   except Exception as e:
     logger.exception(e)
   return None
 
+async def get_storage(tree: str) -> None | object:
+  """Retorna o backend que guarda `tree`"""
+  return await get_db(storage_path(tree))
+
+async def croak_dbs() -> None:
+  """Encerra executor, conexões e todos os bancos de dados abertos"""
+  global storage_executor
+  if storage_executor:
+    storage_executor.shutdown(wait = True)
+    storage_executor = None
+  with storage_lock:
+    while storage_connections:
+      await croak_connection(*storage_connections.pop())
+  while databases:
+    _path, db = databases.popitem()
+    await croak_db(db)
+
+def get_connection(storage: object) -> object:
+  """Retorna a conexão da thread atual com o banco de dados
+
+  Cada thread do executor tem a sua conexão e o seu gerenciador de 
+  transações, então o cache de objetos continua quente entre uma 
+  requisição e outra.
+  """
+  connections: dict[int, object] | None = getattr(
+    storage_local,
+    'connections',
+    None,
+  )
+  if connections is None:
+    connections = storage_local.connections = {}
+  connection: object | None = connections.get(id(storage))
+  if connection is None or not storage.connected(connection):
+    connection = storage.connect()
+    connections[id(storage)] = connection
+    with storage_lock:
+      storage_connections.append((storage, connection))
+  return connection
+
+def valida_tree(tree: str, field: str | None = None) -> None:
+  """Levanta ValueError pra árvore ou índice que não existe"""
+  if tree not in record_fields:
+    raise ValueError(f"Árvore desconhecida: {tree!r}")
+  if field is not None and field not in indices.get(tree, {}):
+    raise ValueError(f"Índice desconhecido: {tree}.{field}")
+
+def limite_valido(limit: int | None) -> int | None:
+  """Limite não negativo, ou None pra sem limite"""
+  return None if limit is None else max(limit, 0)
+
+class Storage(abc.ABC):
+  """Backend de armazenamento de correios e mensagens
+
+  Os jobs rodam no executor como `job(storage, connection, *args)` e só 
+  acessam os dados pelos métodos desta classe, então o mesmo job serve 
+  pra qualquer backend. `tree` é 'correios' ou 'mensagens' e registro é 
+  dicionário com os campos de `record_fields`. Árvore ou índice que não 
+  existe levanta ValueError; escrita só vale depois de `commit`. Backend 
+  novo tem que implementar todos os métodos abstratos.
+  """
+  conflicts: tuple[type[Exception], ...] = ()
+  @abc.abstractmethod
+  def connect(self) -> object:
+    """Abre conexão pra thread atual"""
+  @abc.abstractmethod
+  def connected(self, connection: object) -> bool:
+    """Diz se a conexão ainda está aberta"""
+  @abc.abstractmethod
+  def disconnect(self, connection: object) -> None:
+    """Fecha conexão"""
+  @abc.abstractmethod
+  def run(
+    self,
+    connection: object,
+    job: Callable,
+    args: tuple,
+    tempos: dict[str, float],
+  ) -> object:
+    """Executa job numa transação e descarta o que ficou sem commit
+
+    Os tempos de travessia e commit vão pra `tempos`.
+    """
+  @abc.abstractmethod
+  def commit(self, connection: object) -> None:
+    """Grava a transação atual"""
+  @abc.abstractmethod
+  def close(self) -> None:
+    """Fecha o banco"""
+  @abc.abstractmethod
+  def pack(self, days: float = 0) -> None:
+    """Compacta o banco"""
+  def migrate(self, connection: object, tree: str) -> int:
+    """Constrói o que falta em bancos antigos e retorna quantos"""
+    valida_tree(tree)
+    return 0
+  @abc.abstractmethod
+  def has(self, connection: object, tree: str) -> bool:
+    """Diz se já foi gravado algum registro em `tree`"""
+  @abc.abstractmethod
+  def get(self, connection: object, tree: str, _id: str) -> dict | None:
+    """Registro pelo id"""
+  @abc.abstractmethod
+  def get_many(
+    self,
+    connection: object,
+    tree: str,
+    ids: list[str],
+  ) -> list[dict]:
+    """Registros de `ids` que existem, na ordem de `ids`"""
+  @abc.abstractmethod
+  def lookup(
+    self,
+    connection: object,
+    tree: str,
+    field: str,
+    value: str,
+  ) -> list[str]:
+    """Ids pelo índice `tree.field`, em ordem de id"""
+  @abc.abstractmethod
+  def list_records(self, connection: object, tree: str) -> list[dict]:
+    """Todos os registros de `tree`, em ordem de id"""
+  @abc.abstractmethod
+  def count(self, connection: object, tree: str) -> int:
+    """Quantos registros tem em `tree`"""
+  @abc.abstractmethod
+  def list_page(
+    self,
+    connection: object,
+    offset: int,
+    limit: int | None,
+    newest_first: bool,
+  ) -> list[dict]:
+    """Página de correios em ordem de sequência"""
+  @abc.abstractmethod
+  def since(
+    self,
+    connection: object,
+    since: int,
+    limit: int | None,
+  ) -> list[dict]:
+    """Correios com sequência maior que `since`, em ordem"""
+  @abc.abstractmethod
+  def last_seq(self, connection: object) -> int:
+    """Última sequência de correio, ou 0"""
+  @abc.abstractmethod
+  def insert(self, connection: object, tree: str, record: dict) -> dict:
+    """Insere registro com id novo (e seq nova, nos correios)"""
+  @abc.abstractmethod
+  def put(self, connection: object, tree: str, records: list[dict]) -> None:
+    """Grava registros com id e seq originais, sobrescrevendo"""
+  @abc.abstractmethod
+  def version(self, connection: object, tree: str) -> int:
+    """Versão persistente de `tree`"""
+  @abc.abstractmethod
+  def bump_version(self, connection: object, tree: str) -> None:
+    """Incrementa a versão persistente de `tree`"""
+
+class ZODBStorage(Storage):
+  """Backend ZODB: um banco (FileStorage ou ZEO) por árvore
+
+  Registros são tuplas num OOBTree, os índices secundários ficam em 
+  root.indices e a sequência dos correios em root.correios_seq.
+  """
+  conflicts: tuple[type[Exception], ...] = (
+    ZODB.POSException.ConflictError,
+  )
+  def __init__(self, db: object) -> None:
+    self.db: object = db
+  def connect(self) -> object:
+    """Conexão com gerenciador de transações próprio"""
+    return self.db.open(
+      transaction_manager = transaction.TransactionManager(),
+    )
+  def connected(self, connection: object) -> bool:
+    """Diz se a conexão ainda está aberta"""
+    return connection.opened is not None
+  def disconnect(self, connection: object) -> None:
+    """Descarta a transação e fecha a conexão"""
+    connection.transaction_manager.abort()
+    connection.close()
+  def run(
+    self,
+    connection: object,
+    job: Callable,
+    args: tuple,
+    tempos: dict[str, float],
+  ) -> object:
+    """Executa job numa transação, medindo o commit com hooks"""
+    tm: object = connection.transaction_manager
+    try:
+      marcas: dict[str, float] = {}
+      txn: object = tm.begin()
+      txn.addBeforeCommitHook(
+        marca_tempo,
+        kws = {'marcas': marcas, 'chave': 'commit'},
+      )
+      txn.addAfterCommitHook(
+        marca_tempo,
+        kws = {'marcas': marcas, 'chave': 'committed'},
+      )
+      start: float = time.perf_counter()
+      resultado: object = job(self, connection, *args)
+      commit: float = marcas['committed'] - marcas['commit'] \
+        if 'committed' in marcas else 0.0
+      tempos['traversal'] = time.perf_counter() - start - commit
+      if commit:
+        tempos['commit'] = commit
+      return resultado
+    finally:
+      tm.abort()
+  def commit(self, connection: object) -> None:
+    """Grava a transação atual"""
+    connection.transaction_manager.commit()
+  def close(self) -> None:
+    """Fecha o banco"""
+    self.db.close()
+  def pack(self, days: float = 0) -> None:
+    """Pack do ZODB"""
+    self.db.pack(days = days)
+  def migrate(self, connection: object, tree: str) -> int:
+    """Constrói os índices (e a sequência dos correios) que faltam"""
+    valida_tree(tree)
+    root: object = connection.root
+    existing: set[str] = set(getattr(root, 'indices', {}).keys())
+    missing: list[str] = [
+      field \
+      for field in indices.get(tree, {}) \
+      if f"{tree}.{field}" not in existing \
+    ]
+    for field in missing:
+      get_index(root, tree, field)
+    built: int = len(missing)
+    if tree == 'correios' and not hasattr(root, 'correios_seq'):
+      get_sequence(root)
+      built += 1
+    return built
+  def has(self, connection: object, tree: str) -> bool:
+    """Diz se a árvore já existe"""
+    valida_tree(tree)
+    return getattr(connection.root, tree, None) is not None
+  def get(self, connection: object, tree: str, _id: str) -> dict | None:
+    """Registro pelo id"""
+    valida_tree(tree)
+    record: object | None = getattr(connection.root, tree, {}).get(str(_id))
+    return None if record is None else as_dict(tree, record)
+  def get_many(
+    self,
+    connection: object,
+    tree: str,
+    ids: list[str],
+  ) -> list[dict]:
+    """Registros de `ids` que existem, na ordem de `ids`"""
+    valida_tree(tree)
+    records: object = getattr(connection.root, tree, {})
+    return [
+      as_dict(tree, record) \
+      for record in (records.get(str(_id)) for _id in ids) \
+      if record is not None \
+    ]
+  def lookup(
+    self,
+    connection: object,
+    tree: str,
+    field: str,
+    value: str,
+  ) -> list[str]:
+    """Ids pelo índice `tree.field`, em ordem de id"""
+    valida_tree(tree, field)
+    found: None | str | list[str] = index_lookup(
+      connection.root,
+      tree,
+      field,
+      value,
+    )
+    if found is None:
+      return []
+    return [found] if indices[tree][field] else found
+  def list_records(self, connection: object, tree: str) -> list[dict]:
+    """Todos os registros de `tree`, em ordem de id"""
+    valida_tree(tree)
+    return [
+      as_dict(tree, record) \
+      for record in getattr(connection.root, tree, {}).values() \
+    ]
+  def count(self, connection: object, tree: str) -> int:
+    """Quantos registros tem em `tree`"""
+    valida_tree(tree)
+    return len(getattr(connection.root, tree, {}))
+  def list_page(
+    self,
+    connection: object,
+    offset: int,
+    limit: int | None,
+    newest_first: bool,
+  ) -> list[dict]:
+    """Página de correios pela sequência"""
+    correios: object = getattr(connection.root, 'correios', {})
+    items: object = get_sequence(connection.root).items()
+    if newest_first:
+      stop: int = max(len(items) - offset, 0)
+      window: list = list(items[
+        max(stop - limit, 0) if limit is not None else 0:stop
+      ])[::-1]
+    else:
+      window = list(items[
+        offset:(offset + limit) if limit is not None else None
+      ])
+    return [as_dict('correios', correios[_id]) for (seq, _id) in window]
+  def since(
+    self,
+    connection: object,
+    since: int,
+    limit: int | None,
+  ) -> list[dict]:
+    """Correios com sequência maior que `since`, em ordem"""
+    correios: object = getattr(connection.root, 'correios', {})
+    return [
+      as_dict('correios', correios[_id]) \
+      for (seq, _id) in itertools.islice(
+        get_sequence(connection.root).items(
+          min = since,
+          excludemin = True,
+        ),
+        limit,
+      ) \
+    ]
+  def last_seq(self, connection: object) -> int:
+    """Última sequência de correio, ou 0"""
+    sequence: object | None = getattr(connection.root, 'correios_seq', None)
+    return sequence.maxKey() if sequence else 0
+  def insert(self, connection: object, tree: str, record: dict) -> dict:
+    """Insere registro com id novo (e seq nova, nos correios)"""
+    valida_tree(tree)
+    root: object = connection.root
+    records: object | None = getattr(root, tree, None)
+    if records is None:
+      setattr(root, tree, BTrees.OOBTree.OOBTree())
+      records = getattr(root, tree)
+    record = {**record, 'id': str(uuid.uuid4())}
+    if tree == 'correios':
+      sequence: object = get_sequence(root)
+      record['seq'] = (sequence.maxKey() + 1) if sequence else 1
+      sequence[record['seq']] = record['id']
+    records[record['id']] = as_record(tree, record)
+    index_record(root, tree, record)
+    return as_dict(tree, records[record['id']])
+  def put(self, connection: object, tree: str, records: list[dict]) -> None:
+    """Grava registros com id e seq originais, sobrescrevendo
+
+    O registro sobrescrito sai dos índices antes do novo entrar.
+    """
+    valida_tree(tree)
+    root: object = connection.root
+    tree_records: object | None = getattr(root, tree, None)
+    if tree_records is None:
+      setattr(root, tree, BTrees.OOBTree.OOBTree())
+      tree_records = getattr(root, tree)
+    sequence: object | None = get_sequence(root) if tree == 'correios' \
+      else None
+    for record in records:
+      antigo: object | None = tree_records.get(record['id'])
+      if antigo is not None:
+        unindex_record(root, tree, as_dict(tree, antigo))
+      tree_records[record['id']] = as_record(tree, record)
+      if sequence is not None:
+        sequence[record['seq']] = record['id']
+      index_record(root, tree, record)
+  def version(self, connection: object, tree: str) -> int:
+    """Versão persistente de `tree`"""
+    valida_tree(tree)
+    return getattr(connection.root, f"{tree}_version", 0)
+  def bump_version(self, connection: object, tree: str) -> None:
+    """Incrementa a versão persistente de `tree`"""
+    setattr(
+      connection.root,
+      f"{tree}_version",
+      self.version(connection, tree) + 1,
+    )
+
+sqlite_schema: str = """
+CREATE TABLE IF NOT EXISTS correios (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  id TEXT NOT NULL UNIQUE,
+  de TEXT,
+  para TEXT,
+  mensagem TEXT,
+  chave TEXT UNIQUE
+);
+CREATE INDEX IF NOT EXISTS correios_para ON correios (para, id);
+CREATE TABLE IF NOT EXISTS mensagens (
+  id TEXT PRIMARY KEY,
+  path TEXT NOT NULL UNIQUE,
+  description TEXT,
+  hash TEXT,
+  variantes TEXT
+);
+CREATE INDEX IF NOT EXISTS mensagens_hash ON mensagens (hash);
+CREATE TABLE IF NOT EXISTS meta (
+  nome TEXT PRIMARY KEY,
+  valor INTEGER NOT NULL
+);
+"""
+sqlite_colunas: dict[str, str] = {
+  tree: ", ".join(fields) for (tree, fields) in record_fields.items()
+}
+
+class SQLiteConnection(sqlite3.Connection):
+  """Conexão SQLite que soma o tempo gasto em commit"""
+  commit_seconds: float = 0.0
+  def commit(self) -> None:
+    """Commit medido"""
+    start: float = time.perf_counter()
+    super().commit()
+    self.commit_seconds += time.perf_counter() - start
+
+class SQLiteStorage(Storage):
+  """Backend SQLite em modo WAL
+
+  Correios e mensagens ficam no mesmo arquivo, uma tabela por árvore 
+  com os campos de `record_fields`. A sequência dos correios é a chave 
+  primária e os campos de `indices` têm índice na tabela.
+  """
+  def __init__(self, path: str) -> None:
+    self.path: str = path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    connection: sqlite3.Connection = self.connect()
+    try:
+      connection.executescript(sqlite_schema)
+    finally:
+      connection.close()
+  def connect(self) -> SQLiteConnection:
+    """Abre conexão em WAL com o `sqlite_synchronous` do config
+
+    FULL (padrão) faz fsync a cada commit; NORMAL só no checkpoint e 
+    pode perder os últimos commits se a máquina cair.
+    """
+    connection: SQLiteConnection = sqlite3.connect(
+      self.path,
+      timeout = 30,
+      check_same_thread = False,
+      factory = SQLiteConnection,
+    )
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute(f"PRAGMA synchronous = {sqlite_synchronous}")
+    return connection
+  def connected(self, connection: SQLiteConnection) -> bool:
+    """Diz se a conexão ainda está aberta"""
+    try:
+      connection.total_changes
+    except sqlite3.ProgrammingError:
+      return False
+    return True
+  def disconnect(self, connection: SQLiteConnection) -> None:
+    """Fecha a conexão"""
+    connection.close()
+  def run(
+    self,
+    connection: SQLiteConnection,
+    job: Callable,
+    args: tuple,
+    tempos: dict[str, float],
+  ) -> object:
+    """Executa job numa transação, medindo o commit pela conexão"""
+    try:
+      connection.commit_seconds = 0.0
+      start: float = time.perf_counter()
+      resultado: object = job(self, connection, *args)
+      tempos['traversal'] = time.perf_counter() - start - \
+        connection.commit_seconds
+      if connection.commit_seconds:
+        tempos['commit'] = connection.commit_seconds
+      return resultado
+    finally:
+      connection.rollback()
+  def commit(self, connection: SQLiteConnection) -> None:
+    """Grava a transação atual"""
+    connection.commit()
+  def close(self) -> None:
+    """As conexões são fechadas por croak_dbs"""
+  def pack(self, days: float = 0) -> None:
+    """Equivalente ao pack do ZODB: checkpoint do WAL e VACUUM"""
+    connection: sqlite3.Connection = self.connect()
+    try:
+      connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+      connection.execute("VACUUM")
+    finally:
+      connection.close()
+  def registro(self, tree: str, row: tuple) -> dict:
+    """Linha da tabela -> dicionário igual ao do ZODB"""
+    record: dict = dict(zip(record_fields[tree], row))
+    if record.get('variantes') is not None:
+      record['variantes'] = {
+        int(largura):arquivo \
+        for (largura, arquivo) in json.loads(record['variantes']).items() \
+      }
+    return record
+  def linha(self, tree: str, record: dict) -> tuple:
+    """Dicionário -> linha da tabela, com as variantes em JSON"""
+    return tuple(
+      json.dumps(value) if field == 'variantes' and value is not None \
+      else value \
+      for (field, value) in zip(record_fields[tree], as_record(tree, record)) \
+    )
+  def has(self, connection: SQLiteConnection, tree: str) -> bool:
+    """Diz se a tabela tem alguma linha"""
+    valida_tree(tree)
+    return bool(connection.execute(
+      f"SELECT EXISTS (SELECT 1 FROM {tree})",
+    ).fetchone()[0])
+  def get(
+    self,
+    connection: SQLiteConnection,
+    tree: str,
+    _id: str,
+  ) -> dict | None:
+    """Registro pelo id"""
+    valida_tree(tree)
+    row: tuple | None = connection.execute(
+      f"SELECT {sqlite_colunas[tree]} FROM {tree} WHERE id = ?",
+      (str(_id),),
+    ).fetchone()
+    return None if row is None else self.registro(tree, row)
+  def get_many(
+    self,
+    connection: SQLiteConnection,
+    tree: str,
+    ids: list[str],
+  ) -> list[dict]:
+    """Registros de `ids` que existem, na ordem de `ids`"""
+    valida_tree(tree)
+    ids = [str(_id) for _id in ids]
+    encontrados: dict[str, dict] = {}
+    for start in range(0, len(ids), 500):
+      pedaco: list[str] = ids[start:start + 500]
+      for row in connection.execute(
+        f"SELECT {sqlite_colunas[tree]} FROM {tree} WHERE id IN \
+({', '.join('?' * len(pedaco))})",
+        pedaco,
+      ):
+        record: dict = self.registro(tree, row)
+        encontrados[record['id']] = record
+    return [encontrados[_id] for _id in ids if _id in encontrados]
+  def lookup(
+    self,
+    connection: SQLiteConnection,
+    tree: str,
+    field: str,
+    value: str,
+  ) -> list[str]:
+    """Ids pelo índice `tree.field`, em ordem de id"""
+    valida_tree(tree, field)
+    return [
+      row[0] for row in connection.execute(
+        f"SELECT id FROM {tree} WHERE {field} = ? ORDER BY id",
+        (value,),
+      )
+    ]
+  def list_records(
+    self,
+    connection: SQLiteConnection,
+    tree: str,
+  ) -> list[dict]:
+    """Todos os registros de `tree`, em ordem de id"""
+    valida_tree(tree)
+    return [
+      self.registro(tree, row) for row in connection.execute(
+        f"SELECT {sqlite_colunas[tree]} FROM {tree} ORDER BY id",
+      )
+    ]
+  def count(self, connection: SQLiteConnection, tree: str) -> int:
+    """Quantos registros tem em `tree`"""
+    valida_tree(tree)
+    return connection.execute(f"SELECT count(*) FROM {tree}").fetchone()[0]
+  def list_page(
+    self,
+    connection: SQLiteConnection,
+    offset: int,
+    limit: int | None,
+    newest_first: bool,
+  ) -> list[dict]:
+    """Página de correios pela sequência"""
+    return [
+      self.registro('correios', row) for row in connection.execute(
+        f"SELECT {sqlite_colunas['correios']} FROM correios ORDER BY seq \
+{'DESC' if newest_first else 'ASC'} LIMIT ? OFFSET ?",
+        (-1 if limit is None else limit, offset),
+      )
+    ]
+  def since(
+    self,
+    connection: SQLiteConnection,
+    since: int,
+    limit: int | None,
+  ) -> list[dict]:
+    """Correios com sequência maior que `since`, em ordem"""
+    return [
+      self.registro('correios', row) for row in connection.execute(
+        f"SELECT {sqlite_colunas['correios']} FROM correios WHERE seq > ? \
+ORDER BY seq LIMIT ?",
+        (since, -1 if limit is None else limit),
+      )
+    ]
+  def last_seq(self, connection: SQLiteConnection) -> int:
+    """Última sequência de correio, ou 0"""
+    return connection.execute(
+      "SELECT coalesce(max(seq), 0) FROM correios",
+    ).fetchone()[0]
+  def insert(
+    self,
+    connection: SQLiteConnection,
+    tree: str,
+    record: dict,
+  ) -> dict:
+    """Insere registro com id novo (e seq nova, nos correios)
+
+    A seq vai NULL e o SQLite preenche com a próxima da chave primária.
+    """
+    valida_tree(tree)
+    record = {**record, 'id': str(uuid.uuid4()), 'seq': None}
+    cursor: sqlite3.Cursor = connection.execute(
+      f"INSERT INTO {tree} ({sqlite_colunas[tree]}) \
+VALUES ({', '.join('?' * len(record_fields[tree]))})",
+      self.linha(tree, record),
+    )
+    if tree == 'correios':
+      record['seq'] = cursor.lastrowid
+    return as_dict(tree, as_record(tree, record))
+  def put(
+    self,
+    connection: SQLiteConnection,
+    tree: str,
+    records: list[dict],
+  ) -> None:
+    """Grava registros com id e seq originais, sobrescrevendo"""
+    valida_tree(tree)
+    connection.executemany(
+      f"INSERT OR REPLACE INTO {tree} ({sqlite_colunas[tree]}) \
+VALUES ({', '.join('?' * len(record_fields[tree]))})",
+      [self.linha(tree, record) for record in records],
+    )
+  def version(self, connection: SQLiteConnection, tree: str) -> int:
+    """Versão persistente de `tree`, guardada na tabela meta"""
+    valida_tree(tree)
+    row: tuple | None = connection.execute(
+      "SELECT valor FROM meta WHERE nome = ?",
+      (f"{tree}_version",),
+    ).fetchone()
+    return row[0] if row else 0
+  def bump_version(self, connection: SQLiteConnection, tree: str) -> None:
+    """Incrementa a versão persistente de `tree`"""
+    valida_tree(tree)
+    connection.execute(
+      "INSERT INTO meta (nome, valor) VALUES (?, 1) \
+ON CONFLICT (nome) DO UPDATE SET valor = valor + 1",
+      (f"{tree}_version",),
+    )
+
+def run_job(
+  storage: object,
+  job: Callable,
+  *args,
+  write: bool = False,
+  tempos: dict[str, float] | None = None,
+  libera: Callable | None = None,
+) -> object:
+  """Executa job na thread atual com a conexão dela
+
+  Jobs de escrita no mesmo banco são serializados dentro do processo, 
+  senão todos leem o mesmo fim de sequência e brigam no commit. Os 
+  tempos de checkout da conexão, travessia e commit vão pra `tempos`. 
+  `libera` é chamada no fim do job, mesmo que a requisição que esperava 
+  por ele já tenha desistido.
+  """
+  if tempos is None:
+    tempos = {}
+  falhou: bool = False
+  with storage_lock:
+    storage_metrics['queued'] -= 1
+    storage_metrics['running'] += 1
+    write_lock: threading.Lock = storage_write_locks.setdefault(
+      id(storage),
+      threading.Lock(),
+    )
+  try:
+    start: float = time.perf_counter()
+    connection: object = get_connection(storage)
+    tempos['checkout'] = time.perf_counter() - start
+    for attempt in range(storage_attempts):
+      if write:
+        write_lock.acquire()
+      try:
+        return storage.run(connection, job, args, tempos)
+      except storage.conflicts:
+        if attempt + 1 >= storage_attempts:
+          raise
+        with storage_lock:
+          storage_metrics['conflicts'] += 1
+      finally:
+        if write:
+          write_lock.release()
+  except Exception:
+    falhou = True
+    with storage_lock:
+      storage_metrics['failed'] += 1
+    raise
+  finally:
+    with storage_lock:
+      storage_metrics['running'] -= 1
+      if not falhou:
+        storage_metrics['completed'] += 1
+    if libera is not None:
+      libera()
+
+async def run_db(
+  storage: object,
+  job: Callable,
+  *args,
+  write: bool = False,
+) -> object:
+  """Executa job bloqueante do banco no executor, fora do event loop
+
+  A vaga no semáforo só é devolvida quando o job termina na thread, ou 
+  quando ele é cancelado antes de começar, então o limite de 
+  `queue_depth` vale mesmo com requisições canceladas.
+  """
+  global storage_executor, storage_semaphore
+  if not storage_executor:
+    storage_executor = ThreadPoolExecutor(
+      max_workers = storage_workers,
+      thread_name_prefix = "zodb",
+    )
+  if not storage_semaphore:
+    storage_semaphore = asyncio.Semaphore(storage_queue_depth)
+  storage_metrics['waiting'] += 1
+  try:
+    await storage_semaphore.acquire()
+  finally:
+    storage_metrics['waiting'] -= 1
+  loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+  semaphore: asyncio.Semaphore = storage_semaphore
+  def libera() -> None:
+    """Devolve a vaga no semáforo pelo event loop"""
+    try:
+      loop.call_soon_threadsafe(semaphore.release)
+    except RuntimeError:
+      pass
+  def cancelado(future: Future) -> None:
+    """Job cancelado antes de começar não passa por run_job"""
+    if future.cancelled():
+      with storage_lock:
+        storage_metrics['queued'] -= 1
+      libera()
+  with storage_lock:
+    storage_metrics['queued'] += 1
+    storage_metrics['max_queued'] = max(
+      storage_metrics['max_queued'],
+      storage_metrics['queued'],
+    )
+  tempos: dict[str, float] = {}
+  try:
+    future: Future = storage_executor.submit(
+      run_job,
+      storage,
+      job,
+      *args,
+      write = write,
+      tempos = tempos,
+      libera = libera,
+    )
+  except BaseException:
+    with storage_lock:
+      storage_metrics['queued'] -= 1
+    semaphore.release()
+    raise
+  future.add_done_callback(cancelado)
+  try:
+    return await asyncio.wrap_future(future)
+  finally:
+    for fase, segundos in dict(tempos).items():
+      observe(fase, segundos)
+
+def as_dict(tree: str, record: object) -> dict:
+  """Converte registro guardado no banco em dicionário
+
+  Registros novos são tuplas com os campos de `record_fields` guardadas 
+  direto no bucket da árvore; registros antigos são um OOBTree cada.
+  """
+  if isinstance(record, tuple):
+    return dict(zip(record_fields[tree], record))
+  return {k:v for (k,v) in record.items()}
+
+def as_record(tree: str, data: dict) -> tuple:
+  """Converte dicionário em registro compacto (tupla)"""
+  return tuple(data.get(field) for field in record_fields[tree])
+
+def get_index(root: object, tree: str, field: str) -> object:
+  """Retorna índice secundário `tree.field`, construindo se não existir
+
+  Índices únicos mapeiam valor -> id, os outros mapeiam valor -> 
+  OOTreeSet de ids. Ficam em root.indices e são atualizados na mesma 
+  transação que o registro.
+  """
+  try:
+    _indices: object = root.indices
+  except AttributeError:
+    root.indices = BTrees.OOBTree.OOBTree()
+    _indices = root.indices
+  name: str = f"{tree}.{field}"
+  index: object | None = _indices.get(name)
+  if index is None:
+    index = BTrees.OOBTree.OOBTree()
+    _indices[name] = index
+    records: object = getattr(root, tree, None)
+    if records is not None:
+      for record in records.values():
+        add_to_index(
+          index,
+          field,
+          indices[tree][field],
+          as_dict(tree, record),
+        )
+    logger.info(f"Índice {name} construído com {len(index)} valores")
+  return index
+
+def add_to_index(
+  index: object,
+  field: str,
+  unique: bool,
+  record: object,
+) -> None:
+  """Adiciona registro a um índice"""
+  value: object | None = record.get(field)
+  if value is None:
+    return
+  if unique:
+    index[value] = record['id']
+  else:
+    ids: object | None = index.get(value)
+    if ids is None:
+      ids = BTrees.OOBTree.OOTreeSet()
+      index[value] = ids
+    ids.add(record['id'])
+
+def remove_from_index(
+  index: object,
+  field: str,
+  unique: bool,
+  record: object,
+) -> None:
+  """Tira registro de um índice"""
+  value: object | None = record.get(field)
+  if value is None:
+    return
+  if unique:
+    if index.get(value) == record['id']:
+      del index[value]
+  else:
+    ids: object | None = index.get(value)
+    if ids is not None and record['id'] in ids:
+      ids.remove(record['id'])
+      if not ids:
+        del index[value]
+
+def index_record(root: object, tree: str, record: object) -> None:
+  """Atualiza todos os índices de `tree` com registro novo"""
+  for field, unique in indices.get(tree, {}).items():
+    add_to_index(get_index(root, tree, field), field, unique, record)
+
+def unindex_record(root: object, tree: str, record: object) -> None:
+  """Tira registro antigo de todos os índices de `tree`"""
+  for field, unique in indices.get(tree, {}).items():
+    remove_from_index(get_index(root, tree, field), field, unique, record)
+
+def index_lookup(
+  root: object,
+  tree: str,
+  field: str,
+  value: object,
+) -> None | str | list[str]:
+  """Retorna id (ou lista de ids) pelo índice `tree.field`"""
+  found: object | None = get_index(root, tree, field).get(value)
+  if found is None or indices[tree][field]:
+    return found
+  return list(found)
+
+def _migrate_indices(storage: object, connection: object, tree: str) -> int:
+  """Job que constrói índices e sequência que ainda não existem no banco"""
+  built: int = storage.migrate(connection, tree)
+  if built:
+    storage.commit(connection)
+  return built
+
+async def migrate_indices() -> None:
+  """Migração única: constrói índices e sequência em bancos antigos"""
+  global ultimo_seq
+  for tree in indices:
+    try:
+      db: object = await get_storage(tree)
+      if not db:
+        raise Exception(f"Banco de {tree} não existe ou foi corrompido")
+      built: int = await run_db(
+        db,
+        _migrate_indices,
+        tree,
+        write = True,
+      )
+      if built:
+        logger.info(f"{built} índice(s) de {tree} migrado(s)")
+    except Exception as e:
+      logger.exception(e)
+  try:
+    db: object = await get_storage('correios')
+    if not db:
+      raise Exception("Banco de correios não existe ou foi corrompido")
+    ultimo_seq = await run_db(db, _get_ultimo_seq)
+  except Exception as e:
+    logger.exception(e)
+
+def get_sequence(root: object) -> object:
+  """Retorna IOBTree seq -> id dos correios, construindo se não existir
+
+  A sequência é monotônica e serve de cursor pro feed incremental. 
+  Correios antigos sem `seq` ganham um número na primeira vez.
+  """
+  try:
+    return root.correios_seq
+  except AttributeError:
+    root.correios_seq = BTrees.IOBTree.IOBTree()
+  sequence: object = root.correios_seq
+  correios: object | None = getattr(root, 'correios', None)
+  if correios is not None:
+    for _id, record in list(correios.items()):
+      correio: dict = as_dict('correios', record)
+      correio['seq'] = (sequence.maxKey() + 1) if sequence else 1
+      correios[_id] = as_record('correios', correio)
+      sequence[correio['seq']] = _id
+    logger.info(f"Sequência de correios construída até {len(sequence)}")
+  return sequence
+
+def _get_ultimo_seq(storage: object, connection: object) -> int:
+  """Job que retorna a última sequência de correio"""
+  return storage.last_seq(connection)
+
+def subscribe_display() -> asyncio.Queue:
+  """Inscreve display no hub de correios novos"""
+  queue: asyncio.Queue = asyncio.Queue(maxsize = display_queue_size)
+  display_subscribers.add(queue)
+  return queue
+
+def unsubscribe_display(queue: asyncio.Queue) -> None:
+  """Desinscreve display do hub"""
+  display_subscribers.discard(queue)
+
+def publish_correio(correio: dict) -> None:
+  """Manda correio novo pra todos os displays inscritos
+
+  Display que não deu conta de consumir a fila é desinscrito: a fila 
+  é esvaziada e recebe None, que encerra o stream. O display reconecta 
+  com o último cursor e busca o que perdeu, então o hub nunca guarda 
+  mais que `queue_size` correios por display.
+  """
+  for queue in list(display_subscribers):
+    try:
+      queue.put_nowait(correio)
+    except asyncio.QueueFull:
+      logger.warning("Display atrasado, derrubando stream")
+      unsubscribe_display(queue)
+      while not queue.empty():
+        queue.get_nowait()
+      queue.put_nowait(None)
+
+def _get_correios(
+  storage: object,
+  connection: object,
+  _return: dict,
+  offset: int,
+  limit: int | None,
+  newest_first: bool,
+) -> None:
+  """Job de get_correios"""
+  if not storage.has(connection, 'correios'):
+    _return['error'] = "Não há correios no banco de dados"
+    return
+  _return['data'] = storage.list_page(
+    connection,
+    max(offset, 0),
+    limite_valido(limit),
+    newest_first,
+  )
+  _return['total'] = storage.count(connection, 'correios')
+  _return['cursor'] = storage.last_seq(connection)
+  _return['error'] = "Correios recuperadas do banco de dados"
+  _return['status'] = True
+
 async def get_correios(
+  offset: int = 0,
+  limit: int | None = None,
+  newest_first: bool = False,
   *args,
   **kwargs,
-) -> dict[str, None | bool | str]:
-  """Retorna lista de correios"""
+) -> dict[str, None | bool | str | int]:
+  """Retorna lista de correios, paginada por offset/limit
+
+  Com `newest_first` a página começa pelo correio mais recente.
+  """
   _return: dict[str, str | bool | None] = {
     'status': False,
     'error': "Não deu certo",
     'exception': None,
     'data': None,
+    'total': 0,
+    'cursor': 0,
   }
   try:
-    db: object = await get_db(f"{zodb_path}/correios.fs")
+    db: object = await get_storage('correios')
     if not db:
       _return['error'] = """Banco de correios não existe ou foi \
 corrompido"""
       raise Exception()
-    try:
-      connection: object = db.open()
-      root: object = connection.root
-      correios: list | None = None
-      try:
-        correios = root.correios
-        _return['data'] = [
-          {k:v for (k,v) in correios[c].items()} \
-          for c in correios \
-        ]
-        _return['error'] = "Correios recuperadas do banco de dados"
-        _return['status'] = True
-      except AttributeError as e2:
-        _return['error'] = "Não há correios no banco de dados"
-        _return['exception'] = e2
-      finally:
-        await croak_db(db)
-    except Exception as e1:
-      logger.exception(e1)
-      _return['exception'] = repr(e1)
-      raise
-    finally:
-      await croak_db(db)
+    await run_db(
+      db,
+      _get_correios,
+      _return,
+      max(offset, 0),
+      limit,
+      newest_first,
+    )
+  except Exception as e:
+    logger.exception(e)
+    _return['exception'] = repr(e)
+  return _return
+
+def _get_correios_since(
+  storage: object,
+  connection: object,
+  _return: dict,
+  since: int,
+  limit: int | None,
+) -> None:
+  """Job de get_correios_since"""
+  since = max(since, 0)
+  _return['cursor'] = since
+  if not storage.has(connection, 'correios'):
+    _return['error'] = "Não há correios no banco de dados"
+    return
+  _return['data'] = storage.since(connection, since, limite_valido(limit))
+  if _return['data']:
+    _return['cursor'] = _return['data'][-1]['seq']
+  _return['error'] = "Correios recuperados do banco de dados"
+  _return['status'] = True
+
+async def get_correios_since(
+  since: int = 0,
+  limit: int | None = None,
+  *args,
+  **kwargs,
+) -> dict[str, None | bool | str | int]:
+  """Retorna correios inseridos depois do cursor `since`"""
+  _return: dict[str, str | bool | None] = {
+    'status': False,
+    'error': "Não deu certo",
+    'exception': None,
+    'data': None,
+    'cursor': since,
+  }
+  try:
+    db: object = await get_storage('correios')
+    if not db:
+      _return['error'] = """Banco de correios não existe ou foi \
+corrompido"""
+      raise Exception()
+    await run_db(db, _get_correios_since, _return, since, limit)
   except Exception as e:
     logger.exception(e)
+    _return['exception'] = repr(e)
   return _return
 
+async def gera_correios(
+  since: int = 0,
+  batch: int = 500,
+) -> AsyncIterator[list[dict]]:
+  """Percorre os correios depois de `since` em lotes de `batch`
+
+  Cada lote é um job curto com a sua transação, então o executor não 
+  fica preso e a memória não cresce com o histórico inteiro. Correio 
+  não muda depois de gravado, então seguir o cursor entre transações 
+  dá o mesmo resultado que uma leitura só.
+  """
+  db: object = await get_storage('correios')
+  if not db:
+    raise Exception("Banco de correios não existe ou foi corrompido")
+  cursor: int = since
+  while True:
+    _return: dict[str, object] = {
+      'status': False,
+      'error': None,
+      'exception': None,
+      'data': None,
+    }
+    await run_db(db, _get_correios_since, _return, cursor, batch)
+    if not _return['data']:
+      return
+    yield _return['data']
+    cursor = _return['cursor']
+    if len(_return['data']) < batch:
+      return
+
+def _get_correio(
+  storage: object,
+  connection: object,
+  _return: dict,
+  _id: str,
+) -> None:
+  """Job de get_correio"""
+  if not storage.has(connection, 'correios'):
+    _return['error'] = "Não há correios no banco de dados"
+    return
+  correio: dict | None = storage.get(connection, 'correios', _id)
+  if correio is None:
+    _return['error'] = "Correio não encontrado"
+  else:
+    _return['data'] = correio
+    _return['error'] = "Correio encontrado"
+    _return['status'] = True
+
 async def get_correio(
   _id: str,
   *args,
@@ -165,58 +1580,194 @@ async def get_correio(
     'data': None,
   }
   try:
-    db: object = await get_db(f"{zodb_path}/correios.fs")
+    db: object = await get_storage('correios')
     if not db:
       _return['error'] = """Banco de correios não existe ou foi \
 corrompido"""
       raise Exception()
-    try:
-      connection: object = db.open()
-      root: object = connection.root
-      correios: list | None = None
-      try:
-        correios = root.correios
-        try:
-          correio: dict = [
-            correios[c] \
-            for c in correios \
-            if str(correios[c]['id']) == _id \
-          ][0]
-          _return['data'] = {k:v for (k,v) in correio.items()}
-          _return['error'] = "Correio encontrado"
-          _return['status'] = True
-        except IndexError:
-          _return['error'] = "Correio não encontrado"
-        except Exception as e3:
-          logger.exception(e3)
-          _return['exception'] = e3
-          raise
-        finally:
-          await croak_db(db)
-      except AttributeError as e2:
-        _return['error'] = "Não há correios no banco de dados"
-        _return['exception'] = e2
-        raise
-      finally:
-        await croak_db(db)
-    except Exception as e1:
-      logger.exception(e1)
-      _return['exception'] = repr(e1)
-      raise
-    finally:
-      await croak_db(db)
+    await run_db(db, _get_correio, _return, _id)
   except Exception as e:
     logger.exception(e)
+    _return['exception'] = repr(e)
   return _return
 
-async def set_correio(
+def _get_correios_by_ids(
+  storage: object,
+  connection: object,
+  _return: dict,
+  ids: list[str],
+) -> None:
+  """Job de get_correios_by_ids"""
+  if not storage.has(connection, 'correios'):
+    _return['error'] = "Não há correios no banco de dados"
+    return
+  _return['data'] = storage.get_many(connection, 'correios', ids)
+  _return['error'] = "Correios recuperados do banco de dados"
+  _return['status'] = True
+
+async def get_correios_by_ids(
+  ids: list[str],
+  *args,
+  **kwargs,
+) -> dict[str, None | bool | str]:
+  """Retorna correios a partir de uma lista de ids"""
+  _return: dict[str, str | bool | None] = {
+    'status': False,
+    'error': "Não deu certo",
+    'exception': None,
+    'data': None,
+  }
+  try:
+    db: object = await get_storage('correios')
+    if not db:
+      _return['error'] = """Banco de correios não existe ou foi \
+corrompido"""
+      raise Exception()
+    await run_db(db, _get_correios_by_ids, _return, list(ids))
+  except Exception as e:
+    logger.exception(e)
+    _return['exception'] = repr(e)
+  return _return
+
+def _get_correios_by_para(
+  storage: object,
+  connection: object,
+  _return: dict,
+  para: str,
+) -> None:
+  """Job de get_correios_by_para"""
+  if not storage.has(connection, 'correios'):
+    _return['error'] = "Não há correios no banco de dados"
+    return
+  _return['data'] = storage.get_many(
+    connection,
+    'correios',
+    storage.lookup(connection, 'correios', 'para', para),
+  )
+  _return['error'] = "Correios recuperados do banco de dados"
+  _return['status'] = True
+
+async def get_correios_by_para(
+  para: str,
+  *args,
+  **kwargs,
+) -> dict[str, None | bool | str]:
+  """Retorna correios enviados pra alguém"""
+  _return: dict[str, str | bool | None] = {
+    'status': False,
+    'error': "Não deu certo",
+    'exception': None,
+    'data': None,
+  }
+  try:
+    db: object = await get_storage('correios')
+    if not db:
+      _return['error'] = """Banco de correios não existe ou foi \
+corrompido"""
+      raise Exception()
+    await run_db(db, _get_correios_by_para, _return, para)
+  except Exception as e:
+    logger.exception(e)
+    _return['exception'] = repr(e)
+  return _return
+
+def _set_correio(
+  storage: object,
+  connection: object,
+  _return: dict,
   de: str,
   para: str,
   mensagem: str,
+) -> None:
+  """Job de set_correio"""
+  correio: dict = storage.insert(connection, 'correios', {
+    'de': de,
+    'para': para,
+    'mensagem': mensagem,
+  })
+  storage.commit(connection)
+  _return['data'] = correio
+  _return['error'] = "Correio inserido no banco de dados"
+  _return['status'] = True
+
+def _set_correios_batch(
+  storage: object,
+  connection: object,
+  batch: list[tuple],
+) -> None:
+  """Job de group commit: insere o lote inteiro com um commit só"""
+  correios: list[dict] = [
+    storage.insert(connection, 'correios', {
+      'de': de,
+      'para': para,
+      'mensagem': mensagem,
+    }) \
+    for (_return, de, para, mensagem) in batch \
+  ]
+  storage.commit(connection)
+  for (_return, *_), correio in zip(batch, correios):
+    _return['data'] = correio
+    _return['error'] = "Correio inserido no banco de dados"
+    _return['status'] = True
+
+def _set_correios_lote(
+  storage: object,
+  connection: object,
+  _return: dict,
+  lote: list[dict[str, str]],
+) -> None:
+  """Job de set_correios_lote: grava o lote inteiro numa transação
+
+  Correio com chave que já está no banco (ou que apareceu antes no 
+  mesmo lote) não é gravado de novo: volta como duplicado, com o id 
+  do original.
+  """
+  resultados: list[dict[str, object]] = []
+  inseridos: list[dict] = []
+  for registro in lote:
+    ids: list[str] = storage.lookup(
+      connection,
+      'correios',
+      'chave',
+      registro['chave'],
+    )
+    if ids:
+      resultados.append({
+        'chave': registro['chave'],
+        'status': "duplicado",
+        'id': ids[0],
+      })
+      continue
+    correio: dict = storage.insert(connection, 'correios', {
+      'de': registro['de'],
+      'para': registro['para'],
+      'mensagem': registro['mensagem'],
+      'chave': registro['chave'],
+    })
+    inseridos.append(correio)
+    resultados.append({
+      'chave': registro['chave'],
+      'status': "inserido",
+      'id': correio['id'],
+      'seq': correio['seq'],
+    })
+  storage.commit(connection)
+  _return['data'] = resultados
+  _return['inseridos'] = inseridos
+  _return['error'] = "Lote gravado no banco de dados"
+  _return['status'] = True
+
+async def set_correios_lote(
+  lote: list[dict[str, str]],
   *args,
   **kwargs,
 ) -> dict[str, None | bool | str | object]:
-  """Insere correio novo no banco de dados"""
+  """Insere lote de correios dos quiosques numa transação só
+
+  Registros sem chave, sem `para` ou com mensagem que não está no 
+  catálogo voltam como inválidos e não entram no lote.
+  """
+  global ultimo_seq
   _return: dict[str, str | bool | None] = {
     'status': False,
     'error': "Não deu certo",
@@ -224,48 +1775,441 @@ async def set_correio(
     'data': None,
   }
   try:
-    db: object = await get_db(f"{zodb_path}/correios.fs")
+    db: object = await get_storage('correios')
     if not db:
       _return['error'] = """Banco de correios não existe ou foi \
 corrompido"""
       raise Exception()
+    catalogo: dict[str, object] = {
+      'status': False,
+      'error': None,
+      'exception': None,
+      'data': None,
+    }
+    await load_mensagens(catalogo)
+    ids_mensagens: dict[str, dict] = mensagens_cache['dict'] \
+      if catalogo['status'] else {}
+    resultados: list[dict[str, object] | None] = []
+    validos: list[dict[str, str]] = []
+    for registro in lote:
+      registro = registro if isinstance(registro, dict) else {}
+      chave: object = registro.get('chave')
+      erro: str | None = None
+      if not isinstance(chave, str) or not chave:
+        erro = "Sem chave"
+      elif not isinstance(registro.get('para'), str) or \
+        not registro['para'].strip():
+        erro = "Sem destinatário"
+      elif not isinstance(registro.get('mensagem'), str) or \
+        registro['mensagem'] not in ids_mensagens:
+        erro = "Mensagem não existe"
+      if erro:
+        resultados.append({
+          'chave': chave,
+          'status': "invalido",
+          'error': erro,
+        })
+        continue
+      resultados.append(None)
+      validos.append({
+        'chave': chave,
+        'de': str(registro.get('de') or ""),
+        'para': registro['para'],
+        'mensagem': registro['mensagem'],
+      })
+    gravados: list[dict[str, object]] = []
+    if validos:
+      await run_db(db, _set_correios_lote, _return, validos, write = True)
+      if not _return['status']:
+        raise Exception(_return['error'])
+      gravados = _return.pop('data')
+      for correio in _return.pop('inseridos'):
+        if zeo_poll_task is None:
+          ultimo_seq = max(ultimo_seq, correio['seq'])
+          publish_correio(correio)
+    gravados_iter: object = iter(gravados)
+    _return['data'] = [
+      resultado if resultado is not None else next(gravados_iter) \
+      for resultado in resultados \
+    ]
+    _return['error'] = "Lote processado"
+    _return['status'] = True
+  except Exception as e:
+    logger.exception(e)
+    _return['exception'] = repr(e)
+  return _return
+
+async def group_commit() -> None:
+  """Task que junta correios da fila e grava em lotes
+
+  Espera o primeiro correio, junta o que chegar em até 
+  `group_commit_ms` ou `group_commit_size` correios e grava tudo numa 
+  transação só, com um fsync só. Cada requisição só é liberada depois 
+  do commit do seu lote.
+  """
+  stopping: bool = False
+  while not stopping:
+    item: tuple | None = await correio_queue.get()
+    if item is None:
+      break
+    batch: list[tuple] = [item]
+    deadline: float = asyncio.get_running_loop().time() + \
+      group_commit_ms / 1e3
+    while len(batch) < group_commit_size:
+      timeout: float = deadline - asyncio.get_running_loop().time()
+      try:
+        item = correio_queue.get_nowait() if timeout <= 0 else \
+          await asyncio.wait_for(correio_queue.get(), timeout)
+      except (asyncio.QueueEmpty, asyncio.TimeoutError):
+        break
+      if item is None:
+        stopping = True
+        break
+      batch.append(item)
     try:
-      connection: object = db.open()
-      root: object = connection.root
-      correios: list | None = None
+      db: object = await get_storage('correios')
+      if not db:
+        raise Exception("Banco de correios não existe ou foi corrompido")
+      await run_db(
+        db,
+        _set_correios_batch,
+        [item[:-1] for item in batch],
+        write = True,
+      )
+      storage_metrics['group_commits'] += 1
+      storage_metrics['group_commit_records'] += len(batch)
+      for *_, future in batch:
+        if not future.done():
+          future.set_result(None)
+    except Exception as e:
+      logger.exception(e)
+      for *_, future in batch:
+        if not future.done():
+          future.set_exception(e)
+
+async def start_group_commit() -> None:
+  """Liga o group commit de correios"""
+  global correio_queue, group_commit_task
+  correio_queue = asyncio.Queue(maxsize = storage_queue_depth)
+  group_commit_task = asyncio.create_task(group_commit())
+
+async def stop_group_commit() -> None:
+  """Grava o que sobrou na fila e desliga o group commit"""
+  global correio_queue, group_commit_task
+  if group_commit_task is None:
+    return
+  await correio_queue.put(None)
+  await group_commit_task
+  correio_queue = None
+  group_commit_task = None
+
+def _get_mensagens_version(storage: object, connection: object) -> int:
+  """Job que retorna a versão persistente do catálogo de mensagens"""
+  return storage.version(connection, 'mensagens')
+
+def compartilhado() -> bool:
+  """Diz se outros workers gravam no mesmo banco (ZEO ou SQLite)"""
+  if storage_backend == "sqlite":
+    return uvicorn_workers > 1
+  return zodb_backend == "zeo"
+
+async def zeo_poll() -> None:
+  """Task que sincroniza este worker com os outros via ZEO ou SQLite
+
+  Cada worker só publica no seu hub os correios que ele mesmo vê no 
+  banco, em ordem de sequência, então um display conectado em qualquer 
+  worker recebe os correios de todos. O catálogo de mensagens é 
+  recarregado quando a versão persistente muda.
+  """
+  global ultimo_seq
+  cursor: int = ultimo_seq
+  versao: int | None = None
+  while True:
+    try:
+      correios_db: object = await get_storage('correios')
+      _return: dict = {
+        'status': False,
+        'error': None,
+        'exception': None,
+        'data': None,
+      }
+      await run_db(
+        correios_db,
+        _get_correios_since,
+        _return,
+        cursor,
+        display_window,
+      )
+      for correio in _return['data'] or []:
+        publish_correio(correio)
+      cursor = _return['cursor']
+      ultimo_seq = max(ultimo_seq, cursor)
+      mensagens_db: object = await get_storage('mensagens')
+      atual: int = await run_db(mensagens_db, _get_mensagens_version)
+      if versao is not None and atual != versao:
+        mensagens_cache['version'] += 1
+      versao = atual
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      logger.exception(e)
+    await asyncio.sleep(zodb_poll_ms / 1e3)
+
+async def start_zeo_poll() -> None:
+  """Liga a sincronização entre workers"""
+  global zeo_poll_task
+  zeo_poll_task = asyncio.create_task(zeo_poll())
+
+async def stop_zeo_poll() -> None:
+  """Desliga a sincronização entre workers"""
+  global zeo_poll_task
+  if zeo_poll_task is None:
+    return
+  zeo_poll_task.cancel()
+  try:
+    await zeo_poll_task
+  except asyncio.CancelledError:
+    pass
+  zeo_poll_task = None
+
+def tamanho_db(path: str) -> int | None:
+  """Tamanho do arquivo .fs, se ele estiver neste computador"""
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return None
+
+async def pack_db(path: str, days: float | None = None) -> dict[str, object]:
+  """Compacta um banco de dados e retorna bytes recuperados e duração
+
+  O pack do FileStorage copia as revisões vivas pra um arquivo novo 
+  enquanto os commits continuam; roda numa thread própria pra não 
+  ocupar o executor do ZODB nem o event loop. No fim o FileStorage 
+  salva o `.index`, então o próximo restart não reconstrói o índice.
+  """
+  resultado: dict[str, object] = {
+    'path': path,
+    'bytes_before': tamanho_db(path),
+    'bytes_after': None,
+    'bytes_reclaimed': None,
+    'seconds': None,
+  }
+  db: object = await get_db(path)
+  if not db:
+    raise Exception(f"Banco {path} não existe ou foi corrompido")
+  start: float = time.perf_counter()
+  await asyncio.to_thread(
+    db.pack,
+    days = pack_days if days is None else days,
+  )
+  resultado['seconds'] = time.perf_counter() - start
+  observe('pack', resultado['seconds'])
+  resultado['bytes_after'] = tamanho_db(path)
+  if None not in (resultado['bytes_before'], resultado['bytes_after']):
+    resultado['bytes_reclaimed'] = resultado['bytes_before'] - \
+      resultado['bytes_after']
+    storage_metrics['pack_bytes_reclaimed'] += max(
+      resultado['bytes_reclaimed'],
+      0,
+    )
+  storage_metrics['packs'] += 1
+  pack_state[path] = {
+    'size': resultado['bytes_after'] or 0,
+    'time': time.monotonic(),
+  }
+  logger.info(f"""Pack de {path}: {resultado['bytes_before']} -> \
+{resultado['bytes_after']} bytes em {resultado['seconds']:.2f}s""")
+  return resultado
+
+def precisa_pack(path: str) -> bool:
+  """Diz se o banco passou do intervalo ou do crescimento configurados"""
+  estado: dict[str, float] = pack_state.setdefault(path, {
+    'size': tamanho_db(path) or 0,
+    'time': time.monotonic(),
+  })
+  if pack_interval and \
+    time.monotonic() - estado['time'] >= pack_interval:
+    return True
+  tamanho: int | None = tamanho_db(path)
+  return bool(pack_growth_mb) and tamanho is not None and \
+    tamanho - estado['size'] >= pack_growth_mb * 2**20
+
+async def pack_scheduler() -> None:
+  """Task que compacta os bancos por intervalo ou por crescimento"""
+  checagem: int = min(pack_interval, 60) if pack_interval else 60
+  while True:
+    await asyncio.sleep(checagem)
+    for path in (
+      f"{zodb_path}/correios.fs",
+      f"{zodb_path}/mensagens.fs",
+    ):
       try:
-        correios = root.correios
-      except AttributeError:
-        root.correios = BTrees.OOBTree.OOBTree()
-        correios = root.correios
+        if precisa_pack(path):
+          await pack_db(path)
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        logger.exception(e)
+
+async def start_pack_scheduler() -> None:
+  """Liga a compactação automática"""
+  global pack_task
+  for path in (f"{zodb_path}/correios.fs", f"{zodb_path}/mensagens.fs"):
+    precisa_pack(path)
+  pack_task = asyncio.create_task(pack_scheduler())
+
+async def stop_pack_scheduler() -> None:
+  """Desliga a compactação automática"""
+  global pack_task
+  if pack_task is None:
+    return
+  pack_task.cancel()
+  try:
+    await pack_task
+  except asyncio.CancelledError:
+    pass
+  pack_task = None
+
+def salva_index(path: str, storage: object) -> bool:
+  """Salva o .index do FileStorage se entrou transação desde o último
+
+  Com o .index em dia o FileStorage só lê as transações depois dele ao 
+  abrir; sem ele lê o arquivo inteiro. O FileStorage só salva o índice 
+  no close e no pack, então um processo derrubado no meio da festa 
+  deixaria o próximo restart lento.
+  """
+  if not isinstance(storage, ZODBStorage):
+    return False
+  file_storage: object = getattr(
+    storage.db.storage,
+    'base',
+    storage.db.storage,
+  )
+  if not isinstance(file_storage, ZODB.FileStorage.FileStorage):
+    return False
+  ultima: bytes = file_storage.lastTransaction()
+  if index_saved.get(path) == ultima:
+    return False
+  with file_storage._lock:
+    file_storage._save_index()
+  index_saved[path] = ultima
+  return True
+
+async def index_saver() -> None:
+  """Task que salva os .index periodicamente, começando já no startup"""
+  while True:
+    for path, db in list(databases.items()):
       try:
-        _id: str = str(uuid.uuid4())
-        correios[_id] = BTrees.OOBTree.OOBTree()
-        correio = correios[_id]
-        correio['id'] = _id
-        correio['de'] = de
-        correio['para'] = para
-        correio['mensagem'] = mensagem
-        transaction.commit()
-      except Exception as e3:
-        await croak_transaction(transaction)
-        logger.exception(e3)
-        _return['exception'] = repr(e3)
+        start: float = time.perf_counter()
+        if await asyncio.to_thread(salva_index, path, db):
+          logger.debug(f"""Índice de {path} salvo em \
+{time.perf_counter() - start:.3f}s""")
+      except asyncio.CancelledError:
         raise
-      finally:
-        await croak_db(db)
-      _return['error'] = "Correio inserido no banco de dados"
-      _return['status'] = True
-    except Exception as e1:
-      logger.exception(e1)
-      _return['exception'] = repr(e1)
-      raise
-    finally:
-      await croak_db(db)
+      except Exception as e:
+        logger.exception(e)
+    await asyncio.sleep(index_interval)
+
+async def start_index_saver() -> None:
+  """Liga o salvamento periódico dos .index"""
+  global index_task
+  index_task = asyncio.create_task(index_saver())
+
+async def stop_index_saver() -> None:
+  """Desliga o salvamento periódico dos .index"""
+  global index_task
+  if index_task is None:
+    return
+  index_task.cancel()
+  try:
+    await index_task
+  except asyncio.CancelledError:
+    pass
+  index_task = None
+
+async def set_correio(
+  de: str,
+  para: str,
+  mensagem: str,
+  *args,
+  **kwargs,
+) -> dict[str, None | bool | str | object]:
+  """Insere correio novo no banco de dados"""
+  global ultimo_seq
+  _return: dict[str, str | bool | None] = {
+    'status': False,
+    'error': "Não deu certo",
+    'exception': None,
+    'data': None,
+  }
+  try:
+    db: object = await get_storage('correios')
+    if not db:
+      _return['error'] = """Banco de correios não existe ou foi \
+corrompido"""
+      raise Exception()
+    if correio_queue is not None:
+      future: asyncio.Future = asyncio.get_running_loop().create_future()
+      await correio_queue.put((_return, de, para, mensagem, future))
+      await future
+    else:
+      await run_db(
+        db,
+        _set_correio,
+        _return,
+        de,
+        para,
+        mensagem,
+        write = True,
+      )
+    if _return['status'] and zeo_poll_task is None:
+      ultimo_seq = max(ultimo_seq, _return['data']['seq'])
+      publish_correio(_return['data'])
   except Exception as e:
     logger.exception(e)
+    _return['exception'] = repr(e)
   return _return
 
+def _load_mensagens(
+  storage: object,
+  connection: object,
+  _return: dict,
+) -> None:
+  """Job que materializa o catálogo de mensagens"""
+  if not storage.has(connection, 'mensagens'):
+    _return['error'] = "Não há mensagens no banco de dados"
+    return
+  lista: list[dict] = storage.list_records(connection, 'mensagens')
+  _return['data'] = (
+    lista,
+    {mensagem['id']:mensagem for mensagem in lista},
+  )
+  _return['error'] = "Mensagens recuperadas do banco de dados"
+  _return['status'] = True
+
+async def load_mensagens(_return: dict) -> None:
+  """Preenche o cache do catálogo de mensagens se estiver velho
+
+  O cache guarda a lista e o dicionário id -> mensagem e vale enquanto 
+  a versão carregada for a versão atual, que set_mensagem incrementa.
+  """
+  if mensagens_cache['loaded'] == mensagens_cache['version']:
+    mensagens_cache['hits'] += 1
+    _return['error'] = "Mensagens recuperadas do cache"
+    _return['status'] = True
+    return
+  mensagens_cache['misses'] += 1
+  version: int = mensagens_cache['version']
+  db: object = await get_storage('mensagens')
+  if not db:
+    _return['error'] = """Banco de mensagens não existe ou foi \
+corrompido"""
+    raise Exception()
+  await run_db(db, _load_mensagens, _return)
+  if _return['status']:
+    mensagens_cache['lista'], mensagens_cache['dict'] = _return['data']
+    mensagens_cache['loaded'] = version
+
 async def get_all_mensagens(
   *args,
   **kwargs,
@@ -278,36 +2222,12 @@ async def get_all_mensagens(
     'data': None,
   }
   try:
-    db: object = await get_db(f"{zodb_path}/mensagens.fs")
-    if not db:
-      _return['error'] = """Banco de mensagens não existe ou foi \
-corrompido"""
-      raise Exception()
-    try:
-      connection: object = db.open()
-      root: object = connection.root
-      mensagens: list | None = None
-      try:
-        mensagens = root.mensagens
-        _return['data'] = {
-          k:{sk:sv for (sk,sv) in v.items()} \
-          for (k,v) in mensagens.items() \
-        }
-        _return['error'] = "Mensagens recuperadas do banco de dados"
-        _return['status'] = True
-      except AttributeError as e2:
-        _return['error'] = "Não há mensagens no banco de dados"
-        _return['exception'] = e2
-      finally:
-        await croak_db(db)
-    except Exception as e1:
-      logger.exception(e1)
-      _return['exception'] = repr(e1)
-      raise
-    finally:
-      await croak_db(db)
+    await load_mensagens(_return)
+    if _return['status']:
+      _return['data'] = dict(mensagens_cache['dict'])
   except Exception as e:
     logger.exception(e)
+    _return['exception'] = repr(e)
   return _return
 
 async def get_mensagens(
@@ -322,38 +2242,32 @@ async def get_mensagens(
     'data': None,
   }
   try:
-    db: object = await get_db(f"{zodb_path}/mensagens.fs")
-    if not db:
-      _return['error'] = """Banco de mensagens não existe ou foi \
-corrompido"""
-      raise Exception()
-    try:
-      connection: object = db.open()
-      root: object = connection.root
-      mensagens: list | None = None
-      try:
-        mensagens = root.mensagens
-        _return['data'] = [
-          {k:v for (k,v) in mensagens[m].items()} \
-          for m in mensagens \
-        ]
-        _return['error'] = "Mensagens recuperadas do banco de dados"
-        _return['status'] = True
-      except AttributeError as e2:
-        _return['error'] = "Não há mensagens no banco de dados"
-        _return['exception'] = e2
-      finally:
-        await croak_db(db)
-    except Exception as e1:
-      logger.exception(e1)
-      _return['exception'] = repr(e1)
-      raise
-    finally:
-      await croak_db(db)
+    await load_mensagens(_return)
+    if _return['status']:
+      _return['data'] = list(mensagens_cache['lista'])
   except Exception as e:
     logger.exception(e)
+    _return['exception'] = repr(e)
   return _return
 
+def _get_mensagem(
+  storage: object,
+  connection: object,
+  _return: dict,
+  _id: str,
+) -> None:
+  """Job de get_mensagem"""
+  if not storage.has(connection, 'mensagens'):
+    _return['error'] = "Não há mensagens no banco de dados"
+    return
+  mensagem: dict | None = storage.get(connection, 'mensagens', _id)
+  if mensagem is None:
+    _return['error'] = "Mensagem não encontrada"
+  else:
+    _return['data'] = mensagem
+    _return['error'] = "Mensagem encontrada"
+    _return['status'] = True
+
 async def get_mensagem(
   _id: str,
   *args,
@@ -367,57 +2281,262 @@ async def get_mensagem(
     'data': None,
   }
   try:
-    db: object = await get_db(f"{zodb_path}/mensagens.fs")
+    db: object = await get_storage('mensagens')
     if not db:
       _return['error'] = """Banco de mensagens não existe ou foi \
 corrompido"""
       raise Exception()
-    try:
-      connection: object = db.open()
-      root: object = connection.root
-      mensagens: list | None = None
-      try:
-        mensagens = root.mensagens
-        try:
-          mensagem: dict = [
-            mensagens[m] \
-            for m in mensagens \
-            if str(mensagens[m]['id']) == _id \
-          ][0]
-          _return['data'] = {k:v for (k,v) in mensagem.items()}
-          _return['error'] = "Mensagem encontrada"
-          _return['status'] = True
-        except IndexError:
-          _return['error'] = "Mensagem não encontrada"
-        except Exception as e3:
-          logger.exception(e3)
-          _return['exception'] = e3
-          raise
-        finally:
-          await croak_db(db)
-      except AttributeError as e2:
-        _return['error'] = "Não há mensagens no banco de dados"
-        _return['exception'] = e2
-        raise
-      finally:
-        await croak_db(db)
-    except Exception as e1:
-      logger.exception(e1)
-      _return['exception'] = repr(e1)
-      raise
-    finally:
-      await croak_db(db)
+    await run_db(db, _get_mensagem, _return, _id)
   except Exception as e:
     logger.exception(e)
+    _return['exception'] = repr(e)
   return _return
 
+def caminho_imagem(path: str) -> str:
+  """Resolve `path` dentro de static/imagens
+
+  Levanta ValueError pra caminho absoluto, `..` ou link simbólico que 
+  saia da pasta de imagens.
+  """
+  base: str = os.path.realpath(imagens_path)
+  real: str = os.path.realpath(os.path.join(base, path))
+  if real == base or os.path.commonpath([real, base]) != base:
+    raise ValueError(f"Imagem fora de {imagens_path}: {path!r}")
+  return real
+
+def gera_variantes(path: str) -> dict[str, object]:
+  """Gera miniatura e variantes redimensionadas de uma imagem
+
+  As variantes ficam em static/variantes com o hash do conteúdo no nome 
+  (`<hash>-<largura>.webp`, ou .jpg se o Pillow não tiver WebP), então 
+  só são geradas uma vez por imagem. Retorna hash e {largura: arquivo}.
+  """
+  source: str = caminho_imagem(path)
+  with open(source, "rb") as f:
+    _hash: str = hashlib.sha256(f.read()).hexdigest()[:16]
+  resultado: dict[str, object] = {'hash': _hash, 'variantes': None}
+  try:
+    from PIL import Image
+  except ImportError:
+    logger.warning("Pillow não instalado, variantes não geradas")
+    return resultado
+  os.makedirs(variantes_path, exist_ok = True)
+  variantes: dict[int, str] = {}
+  with Image.open(source) as imagem:
+    imagem.load()
+    for largura in variantes_larguras:
+      existentes: list[str] = [
+        f"{_hash}-{largura}.{ext}" \
+        for ext in ("webp", "jpg") \
+        if os.path.exists(
+          os.path.join(variantes_path, f"{_hash}-{largura}.{ext}"),
+        ) \
+      ]
+      if existentes:
+        variantes[largura] = existentes[0]
+        continue
+      variante: object = imagem.copy()
+      variante.thumbnail((largura, largura * imagem.height))
+      try:
+        nome: str = f"{_hash}-{largura}.webp"
+        variante.save(
+          os.path.join(variantes_path, nome),
+          "WEBP",
+          quality = 80,
+        )
+      except (KeyError, OSError):
+        nome = f"{_hash}-{largura}.jpg"
+        variante.convert("RGB").save(
+          os.path.join(variantes_path, nome),
+          "JPEG",
+          quality = 80,
+          optimize = True,
+        )
+      variantes[largura] = nome
+  resultado['variantes'] = variantes
+  return resultado
+
+def _set_mensagem(
+  storage: object,
+  connection: object,
+  _return: dict,
+  path: str,
+  description: str,
+  variantes: dict[str, object],
+) -> None:
+  """Job de set_mensagem"""
+  if storage.lookup(connection, 'mensagens', 'path', path):
+    _return["status"] = True
+    _return["error"] = "Mensagem já está no banco de dados"
+    return
+  storage.insert(connection, 'mensagens', {
+    'path': path,
+    'description': description,
+    **variantes,
+  })
+  storage.bump_version(connection, 'mensagens')
+  storage.commit(connection)
+  _return['error'] = "Mensagem inserida no banco de dados"
+  _return['status'] = True
+
+def varre_imagens() -> list[dict[str, str]]:
+  """Lista imagens de static/imagens com a descrição do arquivo .txt
+
+  A descrição de `pasta/foto.png` vem de `pasta/foto.txt`, se existir; 
+  senão é o nome do arquivo. A ordem é sempre a mesma: arquivos em ordem 
+  alfabética, cada pasta antes das suas subpastas.
+  """
+  imagens: list[dict[str, str]] = []
+  for pasta, _pastas, arquivos in os.walk(imagens_path):
+    _pastas.sort()
+    for arquivo in sorted(arquivos):
+      tipo: str | None = mimetypes.guess_type(arquivo)[0]
+      if not tipo or not tipo.startswith("image/"):
+        continue
+      nome: str = os.path.splitext(arquivo)[0]
+      description: str = nome
+      try:
+        with open(os.path.join(pasta, f"{nome}.txt")) as f:
+          description = f.read().strip() or nome
+      except FileNotFoundError:
+        pass
+      imagens.append({
+        'path': os.path.relpath(
+          os.path.join(pasta, arquivo),
+          imagens_path,
+        ).replace(os.sep, "/"),
+        'description': description,
+      })
+  return imagens
+
+def _get_mensagens_paths(
+  storage: object,
+  connection: object,
+  paths: list[str],
+) -> set[str]:
+  """Job que retorna quais paths já estão no banco"""
+  return {
+    path for path in paths \
+    if storage.lookup(connection, 'mensagens', 'path', path) \
+  }
+
+def _set_mensagens_batch(
+  storage: object,
+  connection: object,
+  report: dict[str, int],
+  batch: list[dict[str, object]],
+) -> None:
+  """Job de importa_mensagens: insere o lote com um commit só
+
+  Pula path repetido e imagem com o mesmo conteúdo (hash) de uma que já 
+  está no banco, inclusive dentro do próprio lote: entre imagens iguais 
+  fica a cadastrada, ou a primeira na ordem de varre_imagens. As 
+  contagens só vão pro `report` depois do commit, pra não contar duas 
+  vezes num retry.
+  """
+  contagem: dict[str, int] = {
+    'inseridas': 0,
+    'duplicadas_path': 0,
+    'duplicadas_hash': 0,
+  }
+  for item in batch:
+    if storage.lookup(connection, 'mensagens', 'path', item['path']):
+      contagem['duplicadas_path'] += 1
+      continue
+    if item['variantes'].get('hash') and storage.lookup(
+      connection,
+      'mensagens',
+      'hash',
+      item['variantes']['hash'],
+    ):
+      contagem['duplicadas_hash'] += 1
+      continue
+    storage.insert(connection, 'mensagens', {
+      'path': item['path'],
+      'description': item['description'],
+      **item['variantes'],
+    })
+    contagem['inseridas'] += 1
+  if contagem['inseridas']:
+    storage.bump_version(connection, 'mensagens')
+    storage.commit(connection)
+  for chave, quantos in contagem.items():
+    report[chave] += quantos
+
+async def importa_mensagens(batch: int = 500) -> dict[str, object]:
+  """Cadastra de uma vez as imagens de static/imagens
+
+  Imagens com path já cadastrado nem são lidas; as outras ganham hash e 
+  variantes em paralelo e são gravadas em lotes de `batch`, um commit 
+  por lote. Imagem com o mesmo conteúdo de outra não entra: fica a que 
+  já estava no banco, ou a primeira em ordem de path.
+  """
+  if batch < 1:
+    raise ValueError(f"batch tem que ser maior que zero: {batch}")
+  start: float = time.perf_counter()
+  report: dict[str, object] = {
+    'encontradas': 0,
+    'inseridas': 0,
+    'duplicadas_path': 0,
+    'duplicadas_hash': 0,
+    'falhas': 0,
+    'seconds': None,
+  }
+  db: object = await get_storage('mensagens')
+  if not db:
+    raise Exception("Banco de mensagens não existe ou foi corrompido")
+  imagens: list[dict[str, str]] = await asyncio.to_thread(varre_imagens)
+  report['encontradas'] = len(imagens)
+  existentes: set[str] = await run_db(
+    db,
+    _get_mensagens_paths,
+    [imagem['path'] for imagem in imagens],
+  )
+  report['duplicadas_path'] = len(existentes)
+  novas: list[dict[str, str]] = [
+    imagem for imagem in imagens if imagem['path'] not in existentes
+  ]
+  async def prepara(imagem: dict[str, str]) -> dict[str, object] | None:
+    """Calcula hash e variantes de uma imagem"""
+    try:
+      return {
+        **imagem,
+        'variantes': await asyncio.to_thread(gera_variantes, imagem['path']),
+      }
+    except Exception as e:
+      logger.exception(e)
+      report['falhas'] += 1
+      return None
+  try:
+    for i in range(0, len(novas), batch):
+      preparadas: list[dict[str, object] | None] = await asyncio.gather(
+        *[prepara(imagem) for imagem in novas[i:i + batch]],
+      )
+      await run_db(
+        db,
+        _set_mensagens_batch,
+        report,
+        [item for item in preparadas if item is not None],
+        write = True,
+      )
+  finally:
+    mensagens_cache['version'] += 1
+  report['seconds'] = time.perf_counter() - start
+  logger.info(f"""Importação de mensagens: {report['inseridas']} de \
+{report['encontradas']} em {report['seconds']:.2f}s""")
+  return report
+
 async def set_mensagem(
   path: str,
   description: str,
   *args,
   **kwargs,
 ) -> dict[str, None | bool | str | object]:
-  """Insere mensagem nova no banco de dados"""
+  """Insere mensagem nova no banco de dados
+
+  O path tem que apontar pra um arquivo dentro de static/imagens. Path 
+  repetido volta antes de ler a imagem pra gerar variantes.
+  """
   _return: dict[str, str | bool | None] = {
     'status': False,
     'error': "Não deu certo",
@@ -425,55 +2544,56 @@ async def set_mensagem(
     'data': None,
   }
   try:
-    db: object = await get_db(f"{zodb_path}/mensagens.fs")
+    try:
+      caminho_imagem(path)
+    except ValueError:
+      _return['error'] = "Imagem tem que estar em static/imagens"
+      raise
+    db: object = await get_storage('mensagens')
     if not db:
       _return['error'] = """Banco de mensagens não existe ou foi \
 corrompido"""
       raise Exception()
+    if await run_db(db, _get_mensagens_paths, [path]):
+      _return['status'] = True
+      _return['error'] = "Mensagem já está no banco de dados"
+      return _return
+    variantes: dict[str, object] = {}
     try:
-      connection: object = db.open()
-      root: object = connection.root
-      mensagens: list | None = None
-      try:
-        mensagens = root.mensagens
-      except AttributeError:
-        root.mensagens = BTrees.OOBTree.OOBTree()
-        mensagens = root.mensagens
-      if len([
-        m \
-        for m in mensagens \
-        if mensagens[m]['path'] == path \
-      ]) > 0:
-        _return["status"] = True
-        _return["error"] = "Mensagem já está no banco de dados"
-      else:
-        try:
-          _id: str = str(uuid.uuid4())
-          mensagens[_id] = BTrees.OOBTree.OOBTree()
-          mensagem = mensagens[_id]
-          mensagem['id'] = _id
-          mensagem['path'] = path
-          mensagem['description'] = description
-          transaction.commit()
-        except Exception as e3:
-          await croak_transaction(transaction)
-          logger.exception(e3)
-          _return['exception'] = repr(e3)
-          raise
-        finally:
-          await croak_db(db)
-        _return['error'] = "Mensagem inserida no banco de dados"
-        _return['status'] = True
+      variantes = await asyncio.to_thread(gera_variantes, path)
     except Exception as e1:
       logger.exception(e1)
-      _return['exception'] = repr(e1)
-      raise
+      logger.warning(f"Não deu pra gerar variantes de {path}")
+    try:
+      await run_db(
+        db,
+        _set_mensagem,
+        _return,
+        path,
+        description,
+        variantes,
+        write = True,
+      )
     finally:
-      await croak_db(db)
+      mensagens_cache['version'] += 1
   except Exception as e:
     logger.exception(e)
+    _return['exception'] = repr(e)
   return _return
 
+def _importa_registros(
+  storage: object,
+  connection: object,
+  tree: str,
+  registros: list[dict],
+) -> int:
+  """Job de migra_storage: grava registros com id e seq originais"""
+  storage.put(connection, tree, registros)
+  if tree == 'mensagens':
+    storage.bump_version(connection, 'mensagens')
+  storage.commit(connection)
+  return len(registros)
+
 class CorreioForm(FlaskForm):
   """Correio Elegante"""
   de: StringField = StringField(
@@ -516,6 +2636,316 @@ class MensagemForm(FlaskForm):
 app: Quart = Quart(__name__)
 app.secret_key: str = secrets.token_urlsafe(32)
 
+async def renderiza(template: str, **context) -> str:
+  """render_template medido na fase `render`"""
+  start: float = time.perf_counter()
+  try:
+    return await render_template(template, **context)
+  finally:
+    observe('render', time.perf_counter() - start)
+
+def dumps(data: object) -> bytes:
+  """JSON em bytes, com orjson se estiver instalado"""
+  if orjson is not None:
+    return orjson.dumps(data, option = orjson.OPT_NON_STR_KEYS)
+  return json.dumps(data, separators = (",", ":")).encode()
+
+def serializa(data: object) -> Response:
+  """Resposta JSON medida na fase `json`"""
+  start: float = time.perf_counter()
+  try:
+    return Response(dumps(data), mimetype = "application/json")
+  finally:
+    observe('json', time.perf_counter() - start)
+
+@app.before_request
+async def inicia_tempos() -> None:
+  """Marca o início da requisição"""
+  g.inicio = time.perf_counter()
+  g.tempos = {}
+
+@app.after_request
+async def registra_tempos(response: Response) -> Response:
+  """Mede a requisição inteira e loga as lentas
+
+  O limite é `slow_request_ms` na seção `[metricas]`; 0 desliga o log.
+  """
+  try:
+    segundos: float = time.perf_counter() - g.inicio
+    fases: dict[str, float] = dict(g.tempos)
+    observe('request', segundos)
+    if slow_request_ms and segundos * 1e3 >= slow_request_ms:
+      detalhes: str = ", ".join(
+        f"{fase} {tempo * 1e3:.1f}ms" for (fase, tempo) in fases.items()
+      )
+      logger.warning(f"""Requisição lenta: {request.method} {request.path} \
+{segundos * 1e3:.1f}ms ({detalhes})""")
+  except Exception as e:
+    logger.exception(e)
+  return response
+
+@app.template_global()
+def imagem_url(mensagem: dict, largura: int | None = None) -> str:
+  """URL da menor variante com pelo menos `largura` (ou da maior)"""
+  variantes: dict[int, str] | None = mensagem.get('variantes')
+  if not variantes:
+    return url_for('static', filename = 'imagens/' + mensagem['path'])
+  candidatas: list[int] = sorted(variantes)
+  escolhida: int = candidatas[-1]
+  if largura is not None:
+    escolhida = next(
+      (c for c in candidatas if c >= largura),
+      candidatas[-1],
+    )
+  return url_for(
+    'static',
+    filename = 'variantes/' + variantes[escolhida],
+  )
+
+@app.template_global()
+def imagem_srcset(mensagem: dict) -> str:
+  """Atributo srcset com todas as variantes"""
+  variantes: dict[int, str] | None = mensagem.get('variantes')
+  if not variantes:
+    return ""
+  return ", ".join(
+    url_for(
+      'static',
+      filename = 'variantes/' + variantes[largura],
+    ) + f" {largura}w" \
+    for largura in sorted(variantes) \
+  )
+
+def constroi_assets() -> dict[str, int]:
+  """Gera manifesto de static/ com hash no nome e versões comprimidas
+
+  Cada arquivo vira `nome.<hash>.ext` no manifesto e os compressíveis 
+  ganham irmãos .gz (e .br, se o brotli estiver instalado) em 
+  instance/assets. Arquivos com mesmo tamanho e mtime do manifesto 
+  anterior não são relidos.
+  """
+  report: dict[str, int] = {'arquivos': 0, 'novos': 0}
+  os.makedirs(assets_path, exist_ok = True)
+  manifest_file: str = os.path.join(assets_path, "manifest.json")
+  antigo: dict[str, dict] = {}
+  try:
+    with open(manifest_file) as f:
+      antigo = json.load(f)
+  except (FileNotFoundError, ValueError):
+    pass
+  manifest: dict[str, dict] = {}
+  for pasta, _pastas, arquivos in os.walk(static_path):
+    for arquivo in arquivos:
+      path: str = os.path.join(pasta, arquivo)
+      filename: str = os.path.relpath(path, static_path).replace(
+        os.sep,
+        "/",
+      )
+      stat: os.stat_result = os.stat(path)
+      entry: dict | None = antigo.get(filename)
+      report['arquivos'] += 1
+      if entry and entry['size'] == stat.st_size and \
+        entry['mtime'] == stat.st_mtime and all(
+          os.path.exists(entry[encoding]) \
+          for encoding in ('gzip', 'br') \
+          if entry.get(encoding) \
+        ):
+        manifest[filename] = entry
+        continue
+      report['novos'] += 1
+      with open(path, "rb") as f:
+        data: bytes = f.read()
+      _hash: str = hashlib.sha256(data).hexdigest()[:12]
+      base, ext = os.path.splitext(filename)
+      entry = {
+        'path': path,
+        'hashed': f"{base}.{_hash}{ext}",
+        'etag': _hash,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'mimetype': mimetypes.guess_type(filename)[0] or \
+          "application/octet-stream",
+      }
+      if ext in assets_compress:
+        sibling: str = os.path.join(
+          assets_path,
+          entry['hashed'].replace("/", "_"),
+        )
+        with open(f"{sibling}.gz", "wb") as f:
+          f.write(gzip.compress(data, 9))
+        entry['gzip'] = f"{sibling}.gz"
+        if brotli is not None:
+          with open(f"{sibling}.br", "wb") as f:
+            f.write(brotli.compress(data))
+          entry['br'] = f"{sibling}.br"
+      manifest[filename] = entry
+  with open(manifest_file, "w") as f:
+    json.dump(manifest, f)
+  carrega_assets(manifest)
+  return report
+
+def carrega_assets(manifest: dict[str, dict]) -> None:
+  """Carrega manifesto na memória
+
+  Só o conteúdo dos assets de texto pequenos (CSS, JS, etc.) fica na 
+  memória; imagens e o resto são lidos do disco a cada requisição.
+  """
+  hashed: dict[str, dict] = {}
+  for entry in manifest.values():
+    entry = dict(entry)
+    hashed[entry['hashed']] = entry
+    if os.path.splitext(entry['path'])[1] not in assets_compress:
+      continue
+    for encoding in ('identity', 'gzip', 'br'):
+      path: str | None = entry['path'] if encoding == 'identity' else \
+        entry.get(encoding)
+      if path and os.path.getsize(path) <= assets_memory_limit:
+        entry[f"{encoding}_data"] = le_asset(path)
+  assets_hashed.clear()
+  assets_hashed.update(hashed)
+  assets_manifest.clear()
+  assets_manifest.update(manifest)
+
+def le_asset(path: str) -> bytes:
+  """Lê um arquivo de asset inteiro"""
+  with open(path, "rb") as f:
+    return f.read()
+
+@app.url_defaults
+def hashed_static(endpoint: str, values: dict) -> None:
+  """Troca static/arquivo por static/arquivo.<hash> quando tem no 
+  manifesto"""
+  if endpoint == 'static' and values.get('filename') in assets_manifest:
+    values['filename'] = assets_manifest[values['filename']]['hashed']
+
+async def serve_static(filename: str) -> object:
+  """Serve static/ com cache longo pros arquivos com hash no nome
+
+  Cada codificação (identity, gzip, br) tem o seu ETag, já que a 
+  resposta varia com Accept-Encoding.
+  """
+  entry: dict | None = assets_hashed.get(filename)
+  if entry is None:
+    response: object = await app.send_static_file(filename)
+    if filename.startswith("variantes/"):
+      response.headers['Cache-Control'] = \
+        "public, max-age=31536000, immutable"
+    return response
+  headers: dict[str, str] = {
+    'Cache-Control': "public, max-age=31536000, immutable",
+    'Vary': "Accept-Encoding",
+  }
+  aceita: str = request.headers.get("Accept-Encoding", "")
+  encoding: str = "identity"
+  etag: str = entry['etag']
+  for candidato, sufixo in (('br', "br"), ('gzip', "gz")):
+    if entry.get(candidato) and candidato in aceita:
+      encoding = candidato
+      etag = f"{etag}-{sufixo}"
+      headers['Content-Encoding'] = encoding
+      break
+  headers['ETag'] = f'"{etag}"'
+  if request.if_none_match.contains_weak(etag):
+    return Response(b"", 304, headers)
+  data: bytes | None = entry.get(f"{encoding}_data")
+  if data is None:
+    data = await asyncio.to_thread(
+      le_asset,
+      entry['path'] if encoding == "identity" else entry[encoding],
+    )
+  return Response(data, 200, headers, mimetype = entry['mimetype'])
+
+app.view_functions['static'] = serve_static
+
+async def fragmentos_mensagens(mensagens: list[dict]) -> dict[str, object]:
+  """Retorna pedaços renderizados do formulário pra versão atual do 
+  catálogo: o bloco de CSS e a imagem de cada mensagem"""
+  version: int = mensagens_cache['loaded']
+  if paginas_cache['fragmentos_version'] == version:
+    paginas_cache['hits'] += 1
+    return paginas_cache['fragmentos']
+  paginas_cache['misses'] += 1
+  fragmentos: dict[str, object] = {
+    'css': Markup(await renderiza(
+      "_mensagens_css.html",
+      mensagens = mensagens,
+    )),
+    'imagens': {
+      mensagem['id']: Markup(await renderiza(
+        "_mensagem_imagem.html",
+        mensagem = mensagem,
+      )) \
+      for mensagem in mensagens \
+    },
+  }
+  paginas_cache['fragmentos'] = fragmentos
+  paginas_cache['fragmentos_version'] = version
+  return fragmentos
+
+@app.before_serving
+async def startup() -> None:
+  """Abre os bancos de dados uma vez só antes de servir
+
+  O que não é preciso pra primeira requisição (manifesto de assets, 
+  .index) fica pra tasks em segundo plano. O tempo de cada etapa vai 
+  pro log e pro /metrics.
+  """
+  global assets_task
+  try:
+    for path in dict.fromkeys(
+      storage_path(tree) for tree in ('correios', 'mensagens')
+    ):
+      start: float = time.perf_counter()
+      if not await get_db(path):
+        logger.critical(f"Não deu pra abrir {path}")
+      startup_times[os.path.basename(path)] = time.perf_counter() - start
+    start = time.perf_counter()
+    await migrate_indices()
+    startup_times['indices'] = time.perf_counter() - start
+    if group_commit_enabled:
+      await start_group_commit()
+    if compartilhado():
+      await start_zeo_poll()
+    elif storage_backend == "zodb":
+      await start_index_saver()
+      if pack_interval or pack_growth_mb:
+        await start_pack_scheduler()
+    assets_task = asyncio.create_task(atualiza_assets())
+    logger.info(f"""Startup em {sum(startup_times.values()) * 1e3:.0f}ms: \
+{", ".join(f"{k} {v * 1e3:.0f}ms" for (k,v) in startup_times.items())}""")
+  except Exception as e:
+    logger.exception(e)
+
+async def atualiza_assets() -> None:
+  """Constrói o manifesto de assets depois que o servidor já subiu
+
+  Até terminar, as páginas saem com os nomes sem hash; no fim o cache 
+  de páginas é invalidado pra elas passarem a usar o manifesto.
+  """
+  try:
+    start: float = time.perf_counter()
+    report: dict[str, int] = await asyncio.to_thread(constroi_assets)
+    paginas_cache['fragmentos_version'] = None
+    paginas_cache['display_key'] = None
+    logger.info(f"""Manifesto de assets: {report['arquivos']} arquivos, \
+{report['novos']} novos em {time.perf_counter() - start:.2f}s""")
+  except Exception as e:
+    logger.exception(e)
+
+@app.after_serving
+async def shutdown() -> None:
+  """Fecha os bancos de dados"""
+  try:
+    await stop_group_commit()
+    await stop_zeo_poll()
+    await stop_pack_scheduler()
+    await stop_index_saver()
+    if assets_task is not None:
+      await assets_task
+    await croak_dbs()
+  except Exception as e:
+    logger.exception(e)
+
 @app.route("/", methods = ['GET', 'POST'])
 # ~ @login_required
 async def correio() -> str:
@@ -524,11 +2954,13 @@ async def correio() -> str:
   exception: str | None = None
   mensagens: list[dict[str, str]] | None = None
   all_mensagens: dict[str, dict] | None = None
+  fragmentos: dict[str, object] | None = None
   form: FlaskForm | None = None
   try:
     _return: dict[str, None | bool | str] = await get_mensagens()
     if _return["status"]:
       mensagens = _return["data"]
+      fragmentos = await fragmentos_mensagens(mensagens)
       random.shuffle(mensagens)
     else:
       error = _return["error"]
@@ -562,7 +2994,7 @@ async def correio() -> str:
     logger.exception(e)
     exception = repr(e)
   try:
-    return await render_template(
+    return await renderiza(
       "correio.html",
       title = "Correio Elegante",
       form = form,
@@ -570,23 +3002,46 @@ async def correio() -> str:
       exception = exception,
       mensagens = mensagens,
       all_mensagens = all_mensagens,
+      fragmentos = fragmentos,
     )
   except Exception as e:
     logger.exception(e)
-    return jsonify(repr(e))
+    return serializa(repr(e))
 
 @app.route("/display")
 # ~ @login_required
 async def display() -> str:
-  """Display de mensagens"""
+  """Display de mensagens
+
+  Sem correios ou mensagens no banco o carrosel sai vazio, mas a página 
+  sai inteira pro display continuar buscando correios novos.
+  """
   error: str | None = None
   exception: str | None = None
-  correios: list[dict[str, str]] | None = None
-  all_mensagens: dict[str, dict] | None = None
+  correios: list[dict[str, str]] = []
+  all_mensagens: dict[str, dict] = {}
+  cursor: int = 0
+  template: str = "display_leve.html" if request.args.get(
+    "modo",
+    display_mode,
+  ) == "leve" else "display.html"
+  key: tuple = (
+    template,
+    ultimo_seq,
+    mensagens_cache['version'],
+  )
+  if paginas_cache['display_key'] == key:
+    paginas_cache['hits'] += 1
+    return paginas_cache['display']
+  paginas_cache['misses'] += 1
   try:
-    _return: dict[str, None | bool | str] = await get_correios()
+    _return: dict[str, None | bool | str] = await get_correios(
+      limit = display_window,
+      newest_first = True,
+    )
     if _return["status"]:
-      correios = _return["data"]
+      correios = _return["data"][::-1]
+      cursor = _return["cursor"]
     else:
       error = _return["error"]
       exception = _return["exception"]
@@ -600,17 +3055,55 @@ async def display() -> str:
     logger.exception(e)
     exception = repr(e)
   try:
-    return await render_template(
-      "display.html",
+    page: str = await renderiza(
+      template,
       title = "Correio Elegante",
       error = error,
       exception = exception,
       correios = correios,
       all_mensagens = all_mensagens,
+      display_window = display_window,
+      cursor = cursor,
+    )
+    if not error and not exception and cursor == key[1]:
+      paginas_cache['display_key'] = key
+      paginas_cache['display'] = page
+    return page
+  except Exception as e:
+    logger.exception(e)
+    return serializa(repr(e))
+
+@app.route("/display/correios")
+# ~ @login_required
+async def display_correios() -> object:
+  """Fragmento HTML com correios novos pro display leve"""
+  since: int = request.args.get("since", 0, type = int)
+  etag: str = correios_etag()
+  nada_novo: Response | None = nao_modificado(etag)
+  if nada_novo is not None:
+    nada_novo.headers["X-Cursor"] = str(since)
+    return nada_novo
+  try:
+    _return: dict[str, None | bool | str] = await get_correios_since(
+      since,
+      display_window,
     )
+    all_mensagens: dict[str, dict] = (await get_all_mensagens())["data"] \
+      or {}
+    response: object = await make_response(await renderiza(
+      "_correio_item.html",
+      correios = _return["data"] or [],
+      all_mensagens = all_mensagens,
+    ))
+    response.headers["X-Cursor"] = str(_return["cursor"])
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
   except Exception as e:
     logger.exception(e)
-    return jsonify(repr(e))
+    response: object = await make_response("", 500)
+    response.headers["X-Cursor"] = str(since)
+    return response
 
 @app.route("/mensagens", methods = ['GET', 'POST'])
 # ~ @login_required
@@ -644,7 +3137,7 @@ async def editar_mensagens() -> str:
     logger.exception(e)
     exception = repr(e)
   try:
-    return await render_template(
+    return await renderiza(
       "mensagens.html",
       title = "Mensagens cadastradas",
       form = form,
@@ -654,20 +3147,95 @@ async def editar_mensagens() -> str:
     )
   except Exception as e:
     logger.exception(e)
-    return jsonify(repr(e))
+    return serializa(repr(e))
+
+def correios_etag() -> str:
+  """ETag das respostas de correios, muda a cada correio novo
+
+  Correio não é editado nem apagado, então a mesma URL com o mesmo 
+  `ultimo_seq` sempre tem a mesma resposta.
+  """
+  return f"correios-{ultimo_seq}"
+
+def nao_modificado(etag: str) -> Response | None:
+  """304 vazio se o cliente mandou If-None-Match com a versão atual"""
+  if request.if_none_match.contains_weak(etag):
+    return Response(
+      b"",
+      304,
+      {'ETag': f'"{etag}"', 'Cache-Control': "no-cache"},
+    )
+  return None
+
+def stream_correios(since: int) -> Response:
+  """Mesma resposta de /api/correios, mas escrita em pedaços
+
+  Os campos de status vão depois de `data`, então um erro no meio do 
+  caminho ainda sai num JSON válido.
+  """
+  async def corpo():
+    """Gera o JSON lote a lote"""
+    cursor: int = since
+    error: str = "Correios recuperados do banco de dados"
+    exception: str | None = None
+    yield b'{"data":['
+    separador: bytes = b""
+    try:
+      async for lote in gera_correios(since):
+        yield separador + b",".join(dumps(correio) for correio in lote)
+        separador = b","
+        cursor = lote[-1]['seq']
+    except Exception as e:
+      logger.exception(e)
+      error = "Não deu certo"
+      exception = repr(e)
+    yield b"]," + dumps({
+      'cursor': cursor,
+      'status': exception is None,
+      'error': error,
+      'exception': exception,
+    })[1:]
+  response: Response = Response(corpo(), mimetype = "application/json")
+  response.timeout = None
+  return response
 
 @app.route("/api/correios")
 # ~ @login_required
 async def api_correios() -> dict[str, str]:
-  """Retorna correios"""
-  response: dict[str, str | bool | None] = {
+  """Retorna correios depois do cursor `since` (até `limit`)
+
+  Sem `since` retorna uma página com `offset`, `limit` e `order` (asc ou 
+  desc, desc começa pelo mais recente). Se nada mudou desde o ETag do 
+  cliente responde 304 sem abrir o banco.
+  """
+  etag: str = correios_etag()
+  nada_novo: Response | None = nao_modificado(etag)
+  if nada_novo is not None:
+    return nada_novo
+  if request.args.get("stream"):
+    return stream_correios(request.args.get("since", 0, type = int))
+  response: dict[str, str | bool | int | None] = {
     "status": False,
     "data": None,
     "error": "Não deu certo",
     "exception": None,
+    "cursor": None,
   }
   try:
-    _return: dict[str, None | bool | str] = await get_correios()
+    limit: int | None = request.args.get("limit", None, type = int)
+    if "since" in request.args:
+      _return: dict[str, None | bool | str] = await get_correios_since(
+        request.args.get("since", 0, type = int),
+        limit,
+      )
+    else:
+      _return: dict[str, None | bool | str] = await get_correios(
+        request.args.get("offset", 0, type = int),
+        limit,
+        request.args.get("order", "asc") == "desc",
+      )
+      response["total"] = _return["total"]
+    response["cursor"] = _return["cursor"]
     if _return["status"]:
       response["status"] = _return["status"]
       response["data"] = _return["data"]
@@ -677,7 +3245,262 @@ async def api_correios() -> dict[str, str]:
   except Exception as e:
     logger.exception(e)
     response["exception"] = repr(e)
-  return jsonify(response)
+  json_response: Response = serializa(response)
+  if response["status"]:
+    json_response.set_etag(etag)
+    json_response.headers["Cache-Control"] = "no-cache"
+  return json_response
+
+def autorizado() -> bool:
+  """Confere o token `Authorization: Bearer` dos quiosques
+
+  Sem `tokens` na seção `[api]` do config.ini ninguém é autorizado. A 
+  comparação é em bytes (compare_digest não aceita str não ASCII): o 
+  cabeçalho volta pros bytes recebidos e o token do config vai em UTF-8.
+  """
+  esquema, _sep, token = request.headers.get("Authorization", "") \
+    .partition(" ")
+  recebido: bytes = token.strip().encode("latin-1", "replace")
+  return esquema.lower() == "bearer" and any(
+    secrets.compare_digest(recebido, api_token.encode("utf-8")) \
+    for api_token in api_tokens \
+  )
+
+@app.route("/api/correios/lote", methods = ['POST'])
+async def api_correios_lote() -> object:
+  """Recebe lote de correios de quiosque que ficou offline
+
+  Corpo: `{"correios": [{"chave", "de", "para", "mensagem"}, ...]}`, 
+  com `chave` gerada no quiosque. Reenviar o mesmo lote é seguro: o que 
+  já foi gravado volta como duplicado. A resposta traz um resultado por 
+  registro, na mesma ordem.
+  """
+  response: dict[str, str | bool | None] = {
+    "status": False,
+    "data": None,
+    "error": "Não deu certo",
+    "exception": None,
+  }
+  if not autorizado():
+    response["error"] = "Não autorizado"
+    return serializa(response), 401
+  try:
+    body: dict | None = await request.get_json(silent = True)
+    lote: object = (body or {}).get("correios") \
+      if isinstance(body, dict) else None
+    if not isinstance(lote, list):
+      response["error"] = "Corpo precisa ter a lista `correios`"
+      return serializa(response), 400
+    if len(lote) > lote_max:
+      response["error"] = f"Lote maior que {lote_max} correios"
+      return serializa(response), 413
+    _return: dict[str, None | bool | str] = await set_correios_lote(lote)
+    response["status"] = _return["status"]
+    response["data"] = _return["data"]
+    response["error"] = _return["error"]
+    response["exception"] = _return["exception"]
+  except Exception as e:
+    logger.exception(e)
+    response["exception"] = repr(e)
+  return serializa(response)
+
+@app.route("/api/correios/export")
+# ~ @login_required
+async def api_correios_export() -> object:
+  """Exporta correios depois de `since` em NDJSON, um por linha"""
+  since: int = request.args.get("since", 0, type = int)
+  async def linhas():
+    """Gera uma linha por correio"""
+    try:
+      async for lote in gera_correios(since):
+        yield b"".join(dumps(correio) + b"\n" for correio in lote)
+    except Exception as e:
+      logger.exception(e)
+  response: Response = Response(
+    linhas(),
+    mimetype = "application/x-ndjson",
+    headers = {
+      'Content-Disposition': "attachment; filename=" + \
+        f"correios-{time.strftime('%Y%m%d-%H%M%S')}.ndjson",
+    },
+  )
+  response.timeout = None
+  return response
+
+@app.route("/api/correios/stream")
+# ~ @login_required
+async def api_correios_stream() -> object:
+  """Stream (Server-Sent Events) de correios novos
+
+  Na reconexão automática o EventSource repete a URL original, então o 
+  `Last-Event-ID` tem precedência sobre `since`. A recuperação manda no 
+  máximo os `display_window` correios mais recentes, que é o que cabe 
+  na janela do display.
+  """
+  since: int = request.headers.get("Last-Event-ID", None, type = int)
+  if since is None:
+    since = request.args.get("since", 0, type = int)
+  queue: asyncio.Queue = subscribe_display()
+  async def events():
+    """Gera eventos SSE"""
+    try:
+      yield f"retry: {int(3e3)}\n\n".encode()
+      _return: dict[str, None | bool | str] = await get_correios_since(
+        max(since, ultimo_seq - display_window),
+        display_window,
+      )
+      last: int = since
+      for correio in _return['data'] or []:
+        last = correio['seq']
+        yield f"id: {last}\ndata: {json.dumps(correio)}\n\n".encode()
+      while True:
+        try:
+          correio: dict | None = await asyncio.wait_for(
+            queue.get(),
+            display_keepalive,
+          )
+        except asyncio.TimeoutError:
+          yield b": keepalive\n\n"
+          continue
+        if correio is None:
+          yield b"event: atrasado\ndata: {}\n\n"
+          break
+        if correio['seq'] <= last:
+          continue
+        last = correio['seq']
+        yield f"id: {last}\ndata: {json.dumps(correio)}\n\n".encode()
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      logger.exception(e)
+    finally:
+      unsubscribe_display(queue)
+  response: object = await make_response(
+    events(),
+    {
+      'Content-Type': "text/event-stream",
+      'Cache-Control': "no-cache",
+      'X-Accel-Buffering': "no",
+    },
+  )
+  response.timeout = None
+  return response
+
+@app.route("/api/mensagens/importa", methods = ['POST'])
+# ~ @login_required
+async def api_importa_mensagens() -> dict[str, str]:
+  """Cadastra as imagens de static/imagens que ainda não estão no banco
+
+  Aceita JSON opcional com `batch` (imagens por commit).
+  """
+  response: dict[str, str | bool | None] = {
+    "status": False,
+    "data": None,
+    "error": "Não deu certo",
+    "exception": None,
+  }
+  body: dict | None = await request.get_json(silent = True)
+  batch: object = body.get("batch", 500) if isinstance(body, dict) \
+    else 500
+  if isinstance(batch, bool) or not isinstance(batch, int) or batch < 1:
+    response["error"] = "`batch` tem que ser inteiro maior que zero"
+    return serializa(response), 400
+  try:
+    response["data"] = await importa_mensagens(batch)
+    response["status"] = True
+    response["error"] = "Mensagens importadas"
+  except Exception as e:
+    logger.exception(e)
+    response["exception"] = repr(e)
+  return serializa(response)
+
+@app.route("/api/metricas")
+# ~ @login_required
+async def api_metricas() -> dict[str, str]:
+  """Retorna métricas do executor e do cache de mensagens"""
+  response: dict[str, str | bool | None] = {
+    "status": False,
+    "data": None,
+    "error": "Não deu certo",
+    "exception": None,
+  }
+  try:
+    with storage_lock:
+      response["data"] = {
+        **storage_metrics,
+        'workers': storage_workers,
+        'queue_depth': storage_queue_depth,
+        'mensagens_cache_hits': mensagens_cache['hits'],
+        'mensagens_cache_misses': mensagens_cache['misses'],
+        'paginas_cache_hits': paginas_cache['hits'],
+        'paginas_cache_misses': paginas_cache['misses'],
+      }
+    response["status"] = True
+  except Exception as e:
+    logger.exception(e)
+    response["exception"] = repr(e)
+  return serializa(response)
+
+def metricas_prometheus() -> str:
+  """Métricas no formato texto do Prometheus"""
+  linhas: list[str] = [
+    "# HELP correio_fase_segundos Duração de cada fase por rota",
+    "# TYPE correio_fase_segundos histogram",
+  ]
+  for (fase, rota), histograma in sorted(timing_metrics.items()):
+    labels: str = f'fase="{fase}",rota="{rota}"'
+    acumulado: int = 0
+    for limite, quantos in zip(
+      (*timing_buckets, "+Inf"),
+      histograma['buckets'],
+    ):
+      acumulado += quantos
+      linhas.append(f"""correio_fase_segundos_bucket{{{labels},\
+le="{limite}"}} {acumulado}""")
+    linhas.append(
+      f"correio_fase_segundos_sum{{{labels}}} {histograma['sum']}",
+    )
+    linhas.append(
+      f"correio_fase_segundos_count{{{labels}}} {histograma['count']}",
+    )
+  with storage_lock:
+    contadores: dict[str, int] = {
+      **{f"storage_{k}":v for (k,v) in storage_metrics.items()},
+      'mensagens_cache_hits': mensagens_cache['hits'],
+      'mensagens_cache_misses': mensagens_cache['misses'],
+      'paginas_cache_hits': paginas_cache['hits'],
+      'paginas_cache_misses': paginas_cache['misses'],
+    }
+  for nome, valor in contadores.items():
+    tipo: str = "gauge" if nome in (
+      'storage_waiting',
+      'storage_queued',
+      'storage_max_queued',
+      'storage_running',
+    ) else "counter"
+    if tipo == "counter":
+      nome = f"{nome}_total"
+    linhas.append(f"# TYPE correio_{nome} {tipo}")
+    linhas.append(f"correio_{nome} {valor}")
+  linhas.append("# TYPE correio_startup_segundos gauge")
+  for fase, segundos in startup_times.items():
+    linhas.append(f'correio_startup_segundos{{fase="{fase}"}} {segundos}')
+  linhas.append("# TYPE correio_displays gauge")
+  linhas.append(f"correio_displays {len(display_subscribers)}")
+  return "\n".join(linhas) + "\n"
+
+@app.route("/metrics")
+# ~ @login_required
+async def metrics() -> object:
+  """Métricas pro Prometheus"""
+  try:
+    return Response(
+      metricas_prometheus(),
+      content_type = "text/plain; version=0.0.4; charset=utf-8",
+    )
+  except Exception as e:
+    logger.exception(e)
+    return serializa(repr(e))
 
 @app.errorhandler(TemplateNotFound)
 @app.errorhandler(404)
@@ -693,12 +3516,299 @@ errado.</p><p><a href='{{url_for("correio") }}'>voltar</a></p>\
 """), 404
   except Exception as e1:
     logger.exception(e1)
-    return jsonify(repr(e1))
+    return serializa(repr(e1))
+
+async def mede_varredura(path: str, tree: str) -> float:
+  """Mede tempo de leitura completa de uma árvore com cache frio"""
+  db: object = await open_db(path)
+  try:
+    connection: object = db.open()
+    start: float = time.perf_counter()
+    for record in getattr(connection.root, tree, {}).values():
+      as_dict(tree, record)
+    elapsed: float = time.perf_counter() - start
+    connection.close()
+    return elapsed
+  finally:
+    await croak_db(db)
+
+async def migra_registros(batch: int = 1000) -> dict[str, dict]:
+  """Converte registros antigos (um OOBTree cada) em tuplas
+
+  Roda com o servidor parado. Depois de converter empacota o banco pra 
+  descartar as revisões velhas e mede tamanho e varredura antes/depois. 
+  Registro em OOBTree só existe no ZODB, então outro backend é erro.
+  """
+  if storage_backend != "zodb":
+    raise ValueError(
+      f"Registros antigos só existem no ZODB, backend é {storage_backend}",
+    )
+  report: dict[str, dict] = {}
+  for tree in record_fields:
+    path: str = f"{zodb_path}/{tree}.fs"
+    if not os.path.exists(path):
+      continue
+    report[tree] = {
+      'bytes_before': os.path.getsize(path),
+      'scan_before': await mede_varredura(path, tree),
+      'converted': 0,
+    }
+    db: object = await open_db(path)
+    try:
+      connection: object = db.open()
+      records: object | None = getattr(connection.root, tree, None)
+      if records is not None:
+        for n, _id in enumerate(list(records.keys()), 1):
+          record: object = records[_id]
+          if not isinstance(record, tuple):
+            records[_id] = as_record(tree, as_dict(tree, record))
+            report[tree]['converted'] += 1
+          if n % batch == 0:
+            transaction.commit()
+            connection.cacheMinimize()
+        transaction.commit()
+      connection.close()
+      db.pack(days = 0)
+    finally:
+      await croak_db(db)
+    report[tree]['bytes_after'] = os.path.getsize(path)
+    report[tree]['scan_after'] = await mede_varredura(path, tree)
+  return report
+
+async def regenera_variantes(todas: bool = False) -> dict[str, int]:
+  """Gera variantes das mensagens que ainda não têm
+
+  Roda com o servidor parado, como migra_registros. Todas as mensagens 
+  são regravadas pelo storage, que refaz os índices, então o índice de 
+  hash fica em dia mesmo em banco que tinha hash fora dele.
+  """
+  report: dict[str, int] = {'geradas': 0, 'falhas': 0, 'puladas': 0}
+  db: object = await get_storage('mensagens')
+  if not db:
+    raise Exception("Banco de mensagens não existe ou foi corrompido")
+  _return: dict[str, object] = {'status': False, 'data': None}
+  await run_db(db, _load_mensagens, _return)
+  if not _return['status']:
+    return report
+  mensagens: list[dict] = _return['data'][0]
+  for mensagem in mensagens:
+    if mensagem.get('variantes') and not todas:
+      report['puladas'] += 1
+      continue
+    try:
+      mensagem.update(
+        await asyncio.to_thread(gera_variantes, mensagem['path']),
+      )
+      report['geradas'] += 1
+    except Exception as e:
+      logger.exception(e)
+      report['falhas'] += 1
+  await run_db(
+    db,
+    _importa_registros,
+    'mensagens',
+    mensagens,
+    write = True,
+  )
+  return report
+
+async def compacta_bancos(days: float | None = None) -> list[dict]:
+  """Compacta correios.fs e mensagens.fs (ou o arquivo SQLite)
+
+  Com backend filestorage roda com o servidor parado (o arquivo fica 
+  travado pelo processo que abriu); com zeo o pack é feito no servidor.
+  """
+  paths: dict[str, None] = dict.fromkeys(
+    storage_path(tree) for tree in ('correios', 'mensagens')
+  )
+  try:
+    return [await pack_db(path, days) for path in paths]
+  finally:
+    await croak_dbs()
+
+async def abre_storage(backend: str) -> dict[str, object]:
+  """Abre os bancos de correios e mensagens de um backend qualquer
+
+  Independe de `backend` na seção `[storage]`, pra migrar e comparar.
+  """
+  if backend == "sqlite":
+    storage: object = await open_storage(sqlite_path, backend)
+    return {'correios': storage, 'mensagens': storage}
+  return {
+    tree: await open_storage(f"{zodb_path}/{tree}.fs", backend) \
+    for tree in ('correios', 'mensagens') \
+  }
+
+async def fecha_storage(dbs: dict[str, object]) -> None:
+  """Fecha os bancos abertos com abre_storage"""
+  await croak_dbs()
+  for db in set(dbs.values()):
+    await croak_db(db)
+
+async def migra_storage(
+  origem: str,
+  destino: str,
+  batch: int = 1000,
+) -> dict[str, object]:
+  """Copia mensagens e correios de um backend pro outro
+
+  Ids, sequência e chaves de idempotência são mantidos, então os 
+  cursores dos displays continuam valendo. Rodar de novo sobrescreve 
+  os mesmos registros. Roda com o servidor parado.
+  """
+  report: dict[str, object] = {'mensagens': 0, 'correios': 0}
+  start: float = time.perf_counter()
+  de: dict[str, object] = await abre_storage(origem)
+  try:
+    para: dict[str, object] = await abre_storage(destino)
+    try:
+      _return: dict[str, object] = {
+        'status': False,
+        'error': None,
+        'exception': None,
+        'data': None,
+      }
+      await run_db(de['mensagens'], _load_mensagens, _return)
+      if _return['status'] and _return['data'][0]:
+        report['mensagens'] = await run_db(
+          para['mensagens'],
+          _importa_registros,
+          'mensagens',
+          _return['data'][0],
+          write = True,
+        )
+      cursor: int = 0
+      while True:
+        _return = {
+          'status': False,
+          'error': None,
+          'exception': None,
+          'data': None,
+        }
+        await run_db(
+          de['correios'],
+          _get_correios_since,
+          _return,
+          cursor,
+          batch,
+        )
+        if not _return['data']:
+          break
+        report['correios'] += await run_db(
+          para['correios'],
+          _importa_registros,
+          'correios',
+          _return['data'],
+          write = True,
+        )
+        cursor = _return['cursor']
+    finally:
+      await fecha_storage(para)
+  finally:
+    await fecha_storage(de)
+  report['seconds'] = time.perf_counter() - start
+  return report
+
+@app.cli.command("gera-variantes")
+@click.option("--todas", is_flag = True, help = "Regera todas")
+def gera_variantes_command(todas: bool) -> None:
+  """Gera miniaturas e variantes das imagens das mensagens"""
+  async def regenera() -> dict[str, int]:
+    """Regera e fecha os bancos"""
+    try:
+      return await regenera_variantes(todas)
+    finally:
+      await croak_dbs()
+  start: float = time.perf_counter()
+  report: dict[str, int] = asyncio.run(regenera())
+  print(f"""{report['geradas']} geradas, {report['puladas']} puladas, \
+{report['falhas']} falhas em {time.perf_counter() - start:.2f}s""")
+
+@app.cli.command("assets")
+def assets_command() -> None:
+  """Gera manifesto e versões comprimidas de static/"""
+  start: float = time.perf_counter()
+  report: dict[str, int] = constroi_assets()
+  print(f"""{report['arquivos']} arquivos, {report['novos']} novos em \
+{time.perf_counter() - start:.2f}s""")
+
+@app.cli.command("migra-registros")
+def migra_registros_command() -> None:
+  """Converte correios.fs e mensagens.fs pro formato compacto"""
+  if storage_backend != "zodb":
+    raise click.UsageError(f"""migra-registros só vale pro backend zodb, \
+o backend configurado é {storage_backend}""")
+  for tree, result in asyncio.run(migra_registros()).items():
+    print(f"""{tree}: {result['converted']} registros convertidos, \
+{result['bytes_before']} -> {result['bytes_after']} bytes, varredura \
+{result['scan_before']:.3f}s -> {result['scan_after']:.3f}s""")
+
+@app.cli.command("importa-mensagens")
+@click.option(
+  "--batch",
+  type = click.IntRange(min = 1),
+  default = 500,
+  help = "Imagens por commit",
+)
+def importa_mensagens_command(batch: int) -> None:
+  """Cadastra as imagens de static/imagens que ainda não estão no banco"""
+  async def importa() -> dict[str, object]:
+    """Importa e fecha os bancos"""
+    try:
+      return await importa_mensagens(batch)
+    finally:
+      await croak_dbs()
+  report: dict[str, object] = asyncio.run(importa())
+  print(f"""{report['encontradas']} imagens, {report['inseridas']} \
+inseridas, {report['duplicadas_path']} já cadastradas, \
+{report['duplicadas_hash']} com conteúdo repetido, {report['falhas']} \
+falhas em {report['seconds']:.2f}s""")
+
+@app.cli.command("migra-storage")
+@click.option(
+  "--de",
+  "origem",
+  type = click.Choice(["zodb", "sqlite"]),
+  default = "zodb",
+)
+@click.option(
+  "--para",
+  "destino",
+  type = click.Choice(["zodb", "sqlite"]),
+  default = "sqlite",
+)
+def migra_storage_command(origem: str, destino: str) -> None:
+  """Copia correios e mensagens entre ZODB e SQLite"""
+  if origem == destino:
+    raise click.UsageError("Origem e destino são o mesmo backend")
+  report: dict[str, object] = asyncio.run(migra_storage(origem, destino))
+  print(f"""{origem} -> {destino}: {report['mensagens']} mensagens, \
+{report['correios']} correios em {report['seconds']:.2f}s""")
+
+@app.cli.command("pack")
+@click.option(
+  "--days",
+  type = float,
+  default = None,
+  help = "Dias de histórico a manter (padrão: pack_days do config.ini)",
+)
+def pack_command(days: float | None) -> None:
+  """Compacta os bancos de dados e mostra quanto foi recuperado"""
+  for result in asyncio.run(compacta_bancos(days)):
+    print(f"""{result['path']}: {result['bytes_before']} -> \
+{result['bytes_after']} bytes ({result['bytes_reclaimed']} recuperados) \
+em {result['seconds']:.2f}s""")
 
 if __name__ == '__main__':
+  import uvicorn
+  if uvicorn_workers > 1 and not compartilhado():
+    logger.warning("""Mais de um worker precisa de backend = zeo ou do \
+storage sqlite, usando um worker só""")
+    uvicorn_workers = 1
   try:
     uvicorn.run(
-      app,
+      "main:app" if uvicorn_workers > 1 else app,
+      workers = uvicorn_workers,
       uds = uvicorn_socket,
       forwarded_allow_ips = "*",
       proxy_headers = True,
@@ -715,7 +3825,8 @@ if __name__ == '__main__':
 Usando TCP/IP""")
   try:
     uvicorn.run(
-      app,
+      "main:app" if uvicorn_workers > 1 else app,
+      workers = uvicorn_workers,
       host = uvicorn_host,
       port = uvicorn_port,
       forwarded_allow_ips = "*",
@@ -8,6 +8,7 @@ logger = logging.getLogger(__name__)
 try:
   import asyncio
   import js
+  import json
   from js import document
   import pyodide
   from pyodide import http
@@ -18,105 +19,172 @@ except Exception as e:
 async def inicializa_correios(*args, **kwargs) -> None:
   """Inicializa correios com o banco de dados"""
   try:
-    global all_mensagens, correios, active_correios, display_correios
-    api_response: object = await http.pyfetch(api_correios)
+    global correios, display_correios, cursor
+    api_response: object = await http.pyfetch(
+      f"{api_correios}?limit={janela}&order=desc",
+    )
     if api_response.status:
       response: dict[str] = await api_response.json()
-      correios = response['data']
-      # ~ index: int = active_correios.index(True)
-      # ~ active_correios = [False for c in range(len(correios))]
-      # ~ try:
-        # ~ active_correios[index + 1] = True
-      # ~ except IndexError:
-        # ~ active_correios[0] = True
+      if not response['status']:
+        return
+      correios = []
+      ids_correios.clear()
       display_correios.element.innerText = ""
-      for i, correio in enumerate(correios):
-        correio_div: Element = document.createElement("div")
-        correio_div.classList.add("carousel-item")
-        setattr(correio_div, 'data-bs-interval', '6000')
-        correio_div.id = f"correio-{i}"
-        if i == 0:
-          correio_div.classList.add("active")
-        # ~ if i == index:
-          # ~ correio_div.classList.add("active")
-        correio_img: Element = document.createElement("img")
-        correio_img.classList.add("d-block")
-        correio_img.classList.add("w-100")
-        correio_img.src = base_img_url + \
-          all_mensagens[correio['mensagem']]['path']
-        correio_img.alt = \
-          all_mensagens[correio['mensagem']]['description']
-        correio_caption: Element = document.createElement("div")
-        correio_caption.classList.add("carousel-caption")
-        correio_caption.classList.add("d-none")
-        correio_caption.classList.add("d-md-block")
-        if correio.get('de') not in ['', ' ', None]:
-          correio_de: Element = document.createElement("h4")
-          correio_de.innerText = f"De: {correio['de']}"
-          correio_caption.appendChild(correio_de)
-        correio_para: Element = document.createElement("h4")
-        correio_para.innerText = f"Para: {correio['para']}"
-        correio_caption.appendChild(correio_para)
-        correio_div.appendChild(correio_img)
-        correio_div.appendChild(correio_caption)
-        display_correios.element.appendChild(correio_div)
+      adiciona_correios((response['data'] or [])[::-1])
+      cursor = max(cursor, response['cursor'] or 0)
+      primeiro: object = display_correios.element.firstElementChild
+      if primeiro:
+        primeiro.classList.add("active")
   except Exception as e:
     logger.exception(e)
 
+def imagem_url(mensagem: dict) -> str:
+  """URL da maior variante da imagem, ou da original se não tiver"""
+  variantes: dict[int, str] | None = mensagem.get('variantes')
+  if variantes:
+    return base_variantes_url + variantes[max(variantes)]
+  return base_img_url + mensagem['path']
+
+def preenche_correio_div(correio_div: object, correio: dict) -> None:
+  """Preenche (ou recicla) o nó de um correio no carrosel"""
+  correio_div.innerText = ""
+  correio_div.id = f"correio-{correio['id']}"
+  correio_img: Element = document.createElement("img")
+  correio_img.classList.add("d-block")
+  correio_img.classList.add("w-100")
+  correio_img.src = imagem_url(all_mensagens[correio['mensagem']])
+  correio_img.alt = \
+    all_mensagens[correio['mensagem']]['description']
+  correio_caption: Element = document.createElement("div")
+  correio_caption.classList.add("carousel-caption")
+  correio_caption.classList.add("d-none")
+  correio_caption.classList.add("d-md-block")
+  if correio.get('de') not in ['', ' ', None]:
+    correio_de: Element = document.createElement("h4")
+    correio_de.innerText = f"De: {correio['de']}"
+    correio_caption.appendChild(correio_de)
+  correio_para: Element = document.createElement("h4")
+  correio_para.innerText = f"Para: {correio['para']}"
+  correio_caption.appendChild(correio_para)
+  correio_div.appendChild(correio_img)
+  correio_div.appendChild(correio_caption)
+
+def adiciona_correios(novos_correios: list[dict]) -> None:
+  """Adiciona correios novos no carrosel, mantendo só os últimos 
+  `janela` correios
+
+  Os nós novos (ou reciclados dos mais velhos) vão pra um 
+  DocumentFragment e entram no carrosel de uma vez só. Se o carrosel 
+  estava vazio o primeiro vira o ativo e o aviso de nenhum correio some.
+  """
+  global correios, cursor
+  inicio: float = js.performance.now()
+  novos: list[dict] = []
+  for novo in novos_correios:
+    if novo['id'] in ids_correios:
+      continue
+    ids_correios.add(novo['id'])
+    novos.append(novo)
+    cursor = max(cursor, novo.get('seq', 0))
+  if not novos:
+    return
+  correios += novos
+  for velho in correios[:-janela]:
+    ids_correios.discard(velho['id'])
+  del correios[:-janela]
+  novos = novos[-janela:]
+  carrosel: object = display_correios.element
+  reciclar: int = max(
+    carrosel.childElementCount + len(novos) - janela,
+    0,
+  )
+  ativo_reciclado: bool = False
+  fragmento: object = document.createDocumentFragment()
+  for i, correio in enumerate(novos):
+    if i < reciclar:
+      correio_div: object = carrosel.firstElementChild
+      if correio_div.classList.contains("active"):
+        correio_div.classList.remove("active")
+        ativo_reciclado = True
+    else:
+      correio_div = document.createElement("div")
+      correio_div.classList.add("carousel-item")
+      setattr(correio_div, 'data-bs-interval', '6000')
+    preenche_correio_div(correio_div, correio)
+    fragmento.appendChild(correio_div)
+  carrosel.appendChild(fragmento)
+  if ativo_reciclado or not carrosel.querySelector(".active"):
+    carrosel.firstElementChild.classList.add("active")
+  nenhum: object = document.getElementById("nenhum_correio")
+  if nenhum:
+    nenhum.hidden = True
+  logger.info(f"""{len(novos)} correio(s) novo(s) ({reciclar} \
+reciclado(s)) em {js.performance.now() - inicio:.1f} ms""")
+
 async def atualiza_correios(*args, **kwargs) -> None:
-  """Atualiza correios com o banco de dados"""
+  """Atualiza correios com o banco de dados
+
+  O ETag da última resposta só vale pra mesma URL (mesmo cursor); se 
+  nada mudou o servidor responde 304 sem corpo.
+  """
   try:
-    global all_mensagens, correios, active_correios, display_correios
-    api_response: object = await http.pyfetch(api_correios)
+    global cursor, etag
+    inicio: float = js.performance.now()
+    url: str = f"{api_correios}?since={cursor}&limit={janela}"
+    headers: dict[str, str] = {}
+    if etag and etag[0] == url:
+      headers['If-None-Match'] = etag[1]
+    api_response: object = await http.pyfetch(url, headers = headers)
+    if api_response.status == 304:
+      logger.info(f"""Nada novo, verificado em \
+{js.performance.now() - inicio:.1f} ms""")
+      return
+    etag = (url, api_response.headers.get("etag"))
     if api_response.status:
       response: dict[str] = await api_response.json()
-      novos_correios: list[dict] = [
-        novo \
-        for novo in response['data'] \
-        if novo['id'] not in \
-        [velho['id'] for velho in correios]
-      ]
-      correios += novos_correios
-      # ~ index: int = active_correios.index(True)
-      # ~ active_correios = [False for c in range(len(correios))]
-      # ~ try:
-        # ~ active_correios[index + 1] = True
-      # ~ except IndexError:
-        # ~ active_correios[0] = True
-      # ~ display_correios.element.innerText = ""
-      for i, correio in enumerate(novos_correios):
-        correio_div: Element = document.createElement("div")
-        correio_div.classList.add("carousel-item")
-        setattr(correio_div, 'data-bs-interval', '6000')
-        correio_div.id = f"correio-{len(correios) + i}"
-        # ~ if i == 0:
-          # ~ correio_div.classList.add("active")
-        # ~ if i == index:
-          # ~ correio_div.classList.add("active")
-        correio_img: Element = document.createElement("img")
-        correio_img.classList.add("d-block")
-        correio_img.classList.add("w-100")
-        correio_img.src = base_img_url + \
-          all_mensagens[correio['mensagem']]['path']
-        correio_img.alt = \
-          all_mensagens[correio['mensagem']]['description']
-        correio_caption: Element = document.createElement("div")
-        correio_caption.classList.add("carousel-caption")
-        correio_caption.classList.add("d-none")
-        correio_caption.classList.add("d-md-block")
-        if correio.get('de') not in ['', ' ', None]:
-          correio_de: Element = document.createElement("h4")
-          correio_de.innerText = f"De: {correio['de']}"
-          correio_caption.appendChild(correio_de)
-        correio_para: Element = document.createElement("h4")
-        correio_para.innerText = f"Para: {correio['para']}"
-        correio_caption.appendChild(correio_para)
-        correio_div.appendChild(correio_img)
-        correio_div.appendChild(correio_caption)
-        display_correios.element.appendChild(correio_div)
+      if not response['status']:
+        return
+      adiciona_correios(response['data'])
+      cursor = max(cursor, response['cursor'])
+    logger.info(f"Atualização em {js.performance.now() - inicio:.1f} ms")
+  except Exception as e:
+    logger.exception(e)
+
+def recebe_correio(event: object) -> None:
+  """Recebe correio novo pelo stream"""
+  try:
+    adiciona_correios([json.loads(event.data)])
   except Exception as e:
     logger.exception(e)
 
+def stream_aberto(*args, **kwargs) -> None:
+  """Stream conectado: desliga o polling"""
+  global atualiza_interval
+  if atualiza_interval is not None:
+    js.clearInterval(atualiza_interval)
+    atualiza_interval = None
+
+def stream_caiu(*args, **kwargs) -> None:
+  """Stream caiu: liga o polling até reconectar"""
+  global atualiza_interval
+  if atualiza_interval is None:
+    atualiza_interval = js.setInterval(atualiza_proxy, int(3e3))
+
+def stream_atrasado(*args, **kwargs) -> None:
+  """Servidor derrubou o stream por atraso: reconecta a partir do cursor"""
+  global stream
+  stream.close()
+  conecta_stream()
+
+def conecta_stream() -> None:
+  """Conecta no stream de correios novos"""
+  global stream
+  stream = js.EventSource.new(f"{api_correios_stream}?since={cursor}")
+  stream.onmessage = recebe_proxy
+  stream.onopen = aberto_proxy
+  stream.onerror = caiu_proxy
+  stream.addEventListener("atrasado", atrasado_proxy)
+
 async def gira_correios(*args, **kwargs) -> None:
   """Gira o carrosel"""
   try:
@@ -137,15 +205,28 @@ async def gira_correios(*args, **kwargs) -> None:
     pass
 
 try:
+  cursor: int = max([c.get('seq', 0) for c in correios] + [0])
+  ids_correios: set[str] = {c['id'] for c in correios}
+  etag: tuple[str, str] | None = None
   active_correios: list[bool] = [False for c in range(len(correios))]
-  active_correios[0] = True
+  if active_correios:
+    active_correios[0] = True
   display_correios: Element = Element("display_correios");
   asyncio.ensure_future(
     inicializa_correios(),
     loop = asyncio.get_running_loop(),
   )
   atualiza_proxy: object = create_proxy(atualiza_correios)
-  atualiza_interval: int = js.setInterval(atualiza_proxy, int(3e3))
+  atualiza_interval: int | None = None
+  stream: object | None = None
+  recebe_proxy: object = create_proxy(recebe_correio)
+  aberto_proxy: object = create_proxy(stream_aberto)
+  caiu_proxy: object = create_proxy(stream_caiu)
+  atrasado_proxy: object = create_proxy(stream_atrasado)
+  if hasattr(js, 'EventSource'):
+    conecta_stream()
+  else:
+    stream_caiu()
   # ~ gira_proxy: object = create_proxy(gira_correios)
   # ~ gira_interval: int = js.setInterval(gira_proxy, int(6e3))
 except Exception as e: